@@ -0,0 +1 @@
+default_app_config = 'faceted_search.apps.FacetedSearchConfig'
@@ -0,0 +1,36 @@
+from django.apps import AppConfig
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# Names of the settings holding facet configs and sort options (as passed
+# to the Searcher) which are checked against the search index on startup
+FACET_CONFIG_SETTINGS = getattr(settings, 'FACET_CONFIG_SETTINGS', ('FACETS_DEFAULT',))
+SORT_CONFIG_SETTINGS = getattr(settings, 'SORT_CONFIG_SETTINGS', ('SORT_OPTIONS',))
+
+class FacetedSearchConfig(AppConfig):
+    name = 'faceted_search'
+    verbose_name = 'Faceted Search'
+
+    def ready(self):
+        '''
+        Check the facet and sort settings against the haystack unified index
+        so that configuration errors fail on startup rather than per request.
+        '''
+        from haystack import connections
+        from faceted_search.checks import check_facets, check_sort_config, check_sort_order
+
+        indexed_fields = connections['default'].get_unified_index().all_searchfields()
+        errors = check_sort_order(getattr(settings, 'FACET_SORT_ORDER', []), indexed_fields)
+        for name in FACET_CONFIG_SETTINGS:
+            if hasattr(settings, name):
+                errors += ['%s: %s' % (name, e) for e in check_facets(getattr(settings, name), indexed_fields)]
+        for name in SORT_CONFIG_SETTINGS:
+            if hasattr(settings, name):
+                errors += ['%s: %s' % (name, e) for e in check_sort_config(getattr(settings, name), indexed_fields)]
+
+        sample_field = getattr(settings, 'FACET_SAMPLE_FIELD', 'sample')
+        if getattr(settings, 'FACET_APPROXIMATE_THRESHOLD', None) is not None and sample_field not in indexed_fields:
+            errors.append("FACET_APPROXIMATE_THRESHOLD needs the SampleField '%s' in the search index" % sample_field)
+
+        if errors:
+            raise ImproperlyConfigured('Invalid faceted search settings:\n%s' % '\n'.join(errors))
@@ -0,0 +1,182 @@
+'''
+A Solr backend for django-haystack with support for the facet types that
+haystack doesn't expose. Use it in place of haystack's SolrEngine:
+
+    HAYSTACK_CONNECTIONS = {
+        'default': {
+            'ENGINE': 'faceted_search.backends.solr_backend.FacetedSolrEngine',
+            ...
+        }
+    }
+'''
+from pysolr import SolrError
+
+from haystack.backends import BaseEngine
+from haystack.backends.solr_backend import SolrSearchBackend, SolrSearchQuery
+from haystack.exceptions import SkipDocument
+from haystack.utils import get_identifier
+
+from faceted_search.cache import index_updated
+from faceted_search.invalidation import default_invalidator
+
+
+class FacetedSolrSearchBackend(SolrSearchBackend):
+
+    def build_search_kwargs(self, query_string, range_facets=None, pivot_facets=None, raw_query_facets=None, **kwargs):
+        search_kwargs = super(FacetedSolrSearchBackend, self).build_search_kwargs(query_string, **kwargs)
+
+        if raw_query_facets:
+            search_kwargs['facet'] = 'on'
+            search_kwargs['facet.query'] = search_kwargs.get('facet.query', []) + list(raw_query_facets)
+
+        if pivot_facets:
+            search_kwargs['facet'] = 'on'
+            search_kwargs['facet.pivot'] = list(pivot_facets)
+
+        if range_facets:
+            search_kwargs['facet'] = 'on'
+            search_kwargs['facet.range'] = range_facets.keys()
+
+            for field, options in range_facets.items():
+                other = [o for o in ('before', 'after') if options.get(o, False)]
+                search_kwargs['f.%s.facet.range.start' % field] = self.conn._from_python(options['start'])
+                search_kwargs['f.%s.facet.range.end' % field] = self.conn._from_python(options['end'])
+                search_kwargs['f.%s.facet.range.gap' % field] = self.conn._from_python(options['gap'])
+                search_kwargs['f.%s.facet.range.hardend' % field] = 'true'
+                # Each value is counted once: ranges are [start TO end} except
+                # the last which includes its upper bound.
+                search_kwargs['f.%s.facet.range.include' % field] = ['lower', 'edge']
+                search_kwargs['f.%s.facet.range.other' % field] = other or 'none'
+
+        return search_kwargs
+
+    def update(self, index, iterable, commit=True):
+        # As SolrSearchBackend.update(), but keeping the prepared documents
+        # for the invalidator rather than preparing them twice
+        docs = []
+
+        for obj in iterable:
+            try:
+                docs.append(index.full_prepare(obj))
+            except SkipDocument:
+                self.log.debug(u"Indexing for object `%s` skipped", obj)
+            except UnicodeDecodeError:
+                if not self.silently_fail:
+                    raise
+
+                self.log.error(u"UnicodeDecodeError while preparing object for update", exc_info=True,
+                               extra={"data": {"index": index,
+                                               "object": get_identifier(obj)}})
+
+        if len(docs) > 0:
+            try:
+                self.conn.add(docs, commit=commit, boost=index.get_field_weights())
+            except (IOError, SolrError) as e:
+                if not self.silently_fail:
+                    raise
+
+                self.log.error("Failed to add documents to Solr: %s", e, exc_info=True)
+
+        index_updated()
+        if default_invalidator is not None:
+            default_invalidator.updated(index, docs)
+
+    def remove(self, obj_or_string, commit=True):
+        super(FacetedSolrSearchBackend, self).remove(obj_or_string, commit=commit)
+        index_updated()
+        if default_invalidator is not None:
+            default_invalidator.removed(obj_or_string)
+
+    def clear(self, models=[], commit=True):
+        super(FacetedSolrSearchBackend, self).clear(models=models, commit=commit)
+        index_updated()
+        if default_invalidator is not None:
+            default_invalidator.cleared(models)
+
+    def _process_results(self, raw_results, **kwargs):
+        results = super(FacetedSolrSearchBackend, self)._process_results(raw_results, **kwargs)
+
+        if hasattr(raw_results, 'facets'):
+            ranges = raw_results.facets.get('facet_ranges', {})
+            for field, details in ranges.items():
+                # Counts are returned as a flat list of value, count pairs
+                counts = details.get('counts', [])
+                details['counts'] = list(zip(counts[::2], counts[1::2]))
+            results['facets']['ranges'] = ranges
+            results['facets']['pivots'] = raw_results.facets.get('facet_pivot', {})
+
+        return results
+
+
+class FacetedSolrSearchQuery(SolrSearchQuery):
+
+    def __init__(self, **kwargs):
+        super(FacetedSolrSearchQuery, self).__init__(**kwargs)
+        self.range_facets = {}
+        self.pivot_facets = []
+        self.raw_query_facets = []
+
+    def add_range_facet(self, field, start, end, gap, before=False, after=False, **kwargs):
+        '''
+        Adds a native range facet on a field, counting values in
+        buckets of `gap` from `start` to `end`. `before` and `after`
+        add the open-ended buckets either side.
+        '''
+        from haystack import connections
+        field_name = connections[self._using].get_unified_index().get_facet_fieldname(field)
+        self.range_facets[field_name] = {
+            'start': start,
+            'end': end,
+            'gap': gap,
+            'before': before,
+            'after': after,
+        }
+
+    def add_pivot_facet(self, fields, exclude_tags=None):
+        '''
+        Adds a pivot facet, counting the values of each field nested within
+        the values of the previous one. Counts are returned keyed by the
+        comma separated facet field names. Filters tagged with any of
+        exclude_tags are ignored when counting.
+        '''
+        from haystack import connections
+        unified_index = connections[self._using].get_unified_index()
+        pivot = ','.join(unified_index.get_facet_fieldname(f) for f in fields)
+        if exclude_tags:
+            pivot = '{!ex=%s}%s' % (','.join(exclude_tags), pivot)
+        self.pivot_facets.append(pivot)
+
+    def add_raw_query_facet(self, query):
+        '''
+        Adds a query facet counting the matches of a complete query (e.g.
+        the narrows of several fields). Unlike haystack's query facets it
+        isn't prefixed with a field name, and its count is returned keyed
+        by the query as given.
+        '''
+        self.raw_query_facets.append(query)
+
+    def build_params(self, spelling_query=None, **kwargs):
+        search_kwargs = super(FacetedSolrSearchQuery, self).build_params(spelling_query, **kwargs)
+
+        if self.range_facets:
+            search_kwargs['range_facets'] = self.range_facets
+
+        if self.pivot_facets:
+            search_kwargs['pivot_facets'] = self.pivot_facets
+
+        if self.raw_query_facets:
+            search_kwargs['raw_query_facets'] = self.raw_query_facets
+
+        return search_kwargs
+
+    def _clone(self, klass=None, using=None):
+        clone = super(FacetedSolrSearchQuery, self)._clone(klass=klass, using=using)
+        clone.range_facets = self.range_facets.copy()
+        clone.pivot_facets = self.pivot_facets[:]
+        clone.raw_query_facets = self.raw_query_facets[:]
+        return clone
+
+
+class FacetedSolrEngine(BaseEngine):
+    backend = FacetedSolrSearchBackend
+    query = FacetedSolrSearchQuery
@@ -0,0 +1,71 @@
+'''
+A stub haystack backend which answers every search with canned facet
+counts after a configurable delay, for load testing the search path
+offline (see the faceted_search_loadtest command). Queries are built by
+the FacetedSolrSearchQuery, so range and pivot facets are exercised too.
+
+    HAYSTACK_CONNECTIONS = {
+        'default': {
+            'ENGINE': 'faceted_search.backends.stub_backend.StubEngine',
+            # processed facet counts, as returned by facet_counts(), or
+            # the path of a JSON file containing them
+            'FACETS': 'loadtest/facets.json',
+            'HITS': 250,
+            # seconds, or a [min, max] range to pick from at random
+            'LATENCY': [0.02, 0.08],
+        }
+    }
+'''
+import copy
+import json
+import random
+import time
+
+import pysolr
+from haystack.backends import BaseEngine, BaseSearchBackend, log_query
+
+from faceted_search.backends.solr_backend import FacetedSolrSearchQuery
+
+
+class StubSearchBackend(BaseSearchBackend):
+
+    def __init__(self, connection_alias, **connection_options):
+        super(StubSearchBackend, self).__init__(connection_alias, **connection_options)
+        facets = connection_options.get('FACETS', {})
+        if isinstance(facets, basestring):
+            with open(facets) as f:
+                facets = json.load(f)
+        self.facets = facets
+        self.hits = connection_options.get('HITS', 0)
+        self.latency = connection_options.get('LATENCY', 0)
+        # Only used by the query class for converting values, never connects
+        self.conn = pysolr.Solr(connection_options.get('URL', 'http://localhost:8983/solr'))
+
+    def update(self, index, iterable, commit=True):
+        pass
+
+    def remove(self, obj_or_string, commit=True):
+        pass
+
+    def clear(self, models=None, commit=True):
+        pass
+
+    @log_query
+    def search(self, query_string, **kwargs):
+        if isinstance(self.latency, (list, tuple)):
+            time.sleep(random.uniform(*self.latency))
+        elif self.latency:
+            time.sleep(self.latency)
+
+        return {
+            'results': [],
+            'hits': self.hits,
+            # post_process_facets() modifies the facets in place
+            'facets': copy.deepcopy(self.facets),
+            'spelling_suggestion': None,
+        }
+
+
+class StubEngine(BaseEngine):
+    backend = StubSearchBackend
+    query = FacetedSolrSearchQuery
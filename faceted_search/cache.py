@@ -0,0 +1,151 @@
+import logging
+import threading
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db.models.signals import post_save, post_delete
+
+from currencies.models import Currency
+
+logger = logging.getLogger(__name__)
+
+# The Django cache used to share parsed facets between processes, e.g. a
+# memcached or redis cache. Facets aren't cached if this isn't set.
+FACET_CACHE_ALIAS = getattr(settings, 'FACET_CACHE_ALIAS', None)
+FACET_CACHE_TIMEOUT = getattr(settings, 'FACET_CACHE_TIMEOUT', 60 * 5)
+# How long a stale copy of facets is kept, for use when facets can't be
+# counted in time (see Searcher's facet_time_budget)
+FACET_CACHE_STALE_TIMEOUT = getattr(settings, 'FACET_CACHE_STALE_TIMEOUT', 60 * 60 * 24)
+
+_currencies = {}
+_currencies_lock = threading.Lock()
+
+def get_currency(code=None):
+    '''
+    Return the Currency for the given code (defaults to
+    settings.DEFAULT_CURRENCY_CODE). Currencies are cached for the life of the
+    process and invalidated whenever a Currency is saved or deleted, so price
+    facet labels don't cost a query per item.
+    '''
+    code = code or settings.DEFAULT_CURRENCY_CODE
+    try:
+        return _currencies[code]
+    except KeyError:
+        pass
+
+    currency = Currency.objects.get(code=code)
+    with _currencies_lock:
+        _currencies[code] = currency
+    return currency
+
+def clear_currency_cache(sender=None, **kwargs):
+    with _currencies_lock:
+        _currencies.clear()
+
+post_save.connect(clear_currency_cache, sender=Currency, dispatch_uid='faceted_search.currency_cache.save')
+post_delete.connect(clear_currency_cache, sender=Currency, dispatch_uid='faceted_search.currency_cache.delete')
+
+INDEX_VERSION_KEY = 'faceted_search:index_version'
+
+def index_updated(sender=None, **kwargs):
+    '''
+    Marks the search index as updated, e.g. so that facet value indexes
+    are rebuilt in every process.
+    '''
+    try:
+        cache.incr(INDEX_VERSION_KEY)
+    except ValueError:
+        cache.set(INDEX_VERSION_KEY, 1, None)
+
+def index_version():
+    return cache.get(INDEX_VERSION_KEY, 0)
+
+def make_cache_key(prefix, *parts):
+    '''
+    A cache key for the given parts (e.g. model, field and filters). Dicts
+    are sorted, single values in them made one-element lists (as filters
+    parsed from a query string are) and strings made unicode so the same
+    filter state always gives the same key.
+    '''
+    def canonical(value):
+        if isinstance(value, dict):
+            return sorted((canonical(k), canonical(v if isinstance(v, (list, tuple, set, dict)) else [v]))
+                          for k, v in value.items())
+        if isinstance(value, (list, tuple, set)):
+            return sorted(canonical(v) for v in value)
+        if isinstance(value, str):
+            return value.decode('utf-8', 'replace')
+        return value
+    parts = [canonical(p) for p in parts]
+    return 'faceted_search:%s:%s' % (prefix, md5(repr(parts)).hexdigest())
+
+def make_facet_key(*parts):
+    '''
+    The key of a facet state in the facet cache and facet snapshots
+    '''
+    return make_cache_key('facets', *parts)
+
+class FacetCache(object):
+    '''
+    Stores facet payloads in a Django cache, so they are shared between
+    worker processes. Payloads are the hit count, the compact tuple
+    encoding from FacetList.encode() rather than pickled
+    FacetList/Facet/FacetItem objects, and whether the counts are
+    approximate. They are rebuilt with FacetList.decode().
+
+    Payloads may be stored with a version of the state (see
+    faceted_search.invalidation); getting them with a different version
+    misses, while stale copies are returned whatever their version.
+    '''
+    def __init__(self, alias='default', timeout=FACET_CACHE_TIMEOUT, stale_timeout=FACET_CACHE_STALE_TIMEOUT):
+        self.alias = alias
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, *parts):
+        return make_facet_key(*parts)
+
+    def get(self, key, version=None):
+        return self._payload(self.cache.get(key), version)
+
+    def get_many(self, keys, versions=None):
+        '''
+        The payloads of the keys that are cached (with their versions, if
+        given) by key
+        '''
+        entries = self.cache.get_many(keys)
+        versions = dict(zip(keys, versions)) if versions is not None else {}
+        payloads = {}
+        for key, entry in entries.iteritems():
+            payload = self._payload(entry, versions.get(key))
+            if payload is not None:
+                payloads[key] = payload
+        return payloads
+
+    def get_stale(self, key):
+        '''
+        The last payload stored for key, even if it has expired or is of
+        an older version
+        '''
+        return self._payload(self.cache.get(self._stale_key(key)))
+
+    def set(self, key, payload, version=None):
+        entry = (version, payload)
+        self.cache.set(key, entry, self.timeout)
+        if self.stale_timeout:
+            self.cache.set(self._stale_key(key), entry, self.stale_timeout)
+
+    def _payload(self, entry, version=None):
+        if entry is None or (version is not None and entry[0] != version):
+            return None
+        return entry[1]
+
+    def _stale_key(self, key):
+        return '%s:stale' % key
+
+facet_cache = FacetCache(FACET_CACHE_ALIAS) if FACET_CACHE_ALIAS else None
@@ -0,0 +1,73 @@
+'''
+Validation of facet and sort configuration against the haystack unified
+index. Each check returns a list of error messages (empty if valid).
+'''
+FACET_TYPES = ('fields', 'queries', 'ranges', 'dates', 'pivots')
+
+def check_facets(facets, indexed_fields):
+    '''
+    Checks a facets config ({'fields': {...}, 'queries': {...}, ...}) as
+    passed to the Searcher.
+    '''
+    errors = []
+    for facet_type, configs in facets.items():
+        if facet_type not in FACET_TYPES:
+            errors.append("Unknown facet type '%s', expected one of %s" % (facet_type, ', '.join(FACET_TYPES)))
+            continue
+        for field, config in configs.items():
+            if field not in indexed_fields:
+                errors.append("Facet field '%s' is not in the search index" % field)
+            elif not indexed_fields[field].faceted:
+                errors.append("Facet field '%s' is not faceted in the search index" % field)
+
+            if config.get('filter_round') not in (None, 'month', 'year'):
+                errors.append("Facet '%s' filter_round must be 'month' or 'year'" % field)
+            if 'filter_cost' in config and config.get('filter_cache') is not False:
+                errors.append("Facet '%s' filter_cost only applies with filter_cache False" % field)
+
+            if facet_type == 'ranges':
+                missing = [k for k in ('start', 'end', 'gap') if k not in config]
+                if missing:
+                    errors.append("Range facet '%s' is missing %s" % (field, ', '.join(missing)))
+                elif not config['gap'] > 0 or not config['start'] < config['end']:
+                    errors.append("Range facet '%s' needs start < end and a positive gap" % field)
+            elif facet_type == 'dates':
+                missing = [k for k in ('start_date', 'end_date', 'gap_by') if k not in config]
+                if missing:
+                    errors.append("Date facet '%s' is missing %s" % (field, ', '.join(missing)))
+                range_field = config.get('range_field')
+                if range_field and range_field not in indexed_fields:
+                    errors.append("Date facet '%s' range_field '%s' is not in the search index" % (field, range_field))
+            elif facet_type == 'pivots':
+                child = config.get('child')
+                if child is None:
+                    errors.append("Hierarchical facet '%s' is missing child" % field)
+                elif child not in indexed_fields or not indexed_fields[child].faceted:
+                    errors.append("Hierarchical facet '%s' child '%s' is not faceted in the search index" % (field, child))
+    return errors
+
+def check_sort_config(sort_config, indexed_fields):
+    '''
+    Checks the sort options as passed to the Searcher.
+    '''
+    errors = []
+    seen = set()
+    for conf in sort_config:
+        field = conf.get('field')
+        if field not in indexed_fields:
+            errors.append("Sort field '%s' is not in the search index" % field)
+        key = (field, conf.get('reverse', False))
+        if key in seen:
+            errors.append("Sort field '%s' (reverse=%s) is configured more than once" % key)
+        seen.add(key)
+    if len([c for c in sort_config if c.get('default', False)]) > 1:
+        errors.append("More than one default sort order is configured")
+    return errors
+
+def check_sort_order(sort_order, indexed_fields):
+    '''
+    Checks settings.FACET_SORT_ORDER. Unknown names are usually missing
+    commas, which concatenate the neighbouring field names.
+    '''
+    return ["Unknown field '%s' in FACET_SORT_ORDER (missing a comma?)" % field
+            for field in sort_order if field not in indexed_fields]
@@ -3,7 +3,7 @@ import os
 
 HAYSTACK_CONNECTIONS = {
     'default': {
-        'ENGINE': 'haystack.backends.solr_backend.SolrEngine',
+        'ENGINE': 'faceted_search.backends.solr_backend.FacetedSolrEngine',
         'URL': 'http://gapadventures-util0.gap.ca:8080/solr',
         'TIMEOUT': 60 * 5,
         'INCLUDE_SPELLING': False,
@@ -17,9 +17,12 @@ HAYSTACK_CONNECTIONS = {
 HAYSTACK_UPDATE_AGE = 1 
 
 #TODO Facet settings should be model specific.
+# 'multiselect' facets accept several values (combined with OR) and keep
+# counts for their other values when one is selected.
+# Any facet may also set backend filter cache hints for its filters
+# (filter_cache, filter_cost, filter_round, filter_group), see
+# faceted_search.searcher.FILTER_OPTIONS.
 FIELD_FACETS = {
-    'region': {},
-    'country': {},
     'trip_style': {},
     'service_level': {},
     'promotion_CAD': {'label': 'Promotions'},
@@ -34,16 +37,31 @@ FIELD_FACETS = {
     'tag': {},
 }
 
-QUERY_FACETS = {
-    'duration': ('[* TO 5]', '[6 TO 10]', '[11 TO 15]', '[16 TO 25]', '[26 TO 40]', '[41 TO *]'),
-    'min_price_CAD': ('[0 TO 500]', '[500 TO 1000]', '[1001 TO 2000]', '[2001 TO *]'), 
-    'min_price_USD': ('[0 TO 500]', '[500 TO 1000]', '[1001 TO 2000]', '[2001 TO *]'), 
-    'min_price_NZD': ('[0 TO 500]', '[500 TO 1000]', '[1001 TO 2000]', '[2001 TO *]'), 
-    'min_price_EUR': ('[0 TO 500]', '[500 TO 1000]', '[1001 TO 2000]', '[2001 TO *]'), 
-    'min_price_USL': ('[0 TO 500]', '[500 TO 1000]', '[1001 TO 2000]', '[2001 TO *]'), 
-    'min_price_GBP': ('[0 TO 500]', '[500 TO 1000]', '[1001 TO 2000]', '[2001 TO *]'), 
-    'min_price_AUD': ('[0 TO 500]', '[500 TO 1000]', '[1001 TO 2000]', '[2001 TO *]'), 
-    'min_price_CHF': ('[0 TO 500]', '[500 TO 1000]', '[1001 TO 2000]', '[2001 TO *]'), 
+# Query facets are counted with one query per value, prefer range facets
+# for numeric buckets.
+QUERY_FACETS = {}
+
+# Range facets are counted with one native range facet per field. Buckets
+# of `gap` run from `start` to `end`, `before` and `after` add open-ended
+# buckets either side.
+PRICE_RANGE = {'start': 0, 'end': 2000, 'gap': 500, 'after': True}
+
+RANGE_FACETS = {
+    'duration': {'start': 5, 'end': 40, 'gap': 5, 'before': True, 'after': True},
+    'min_price_CAD': PRICE_RANGE,
+    'min_price_USD': PRICE_RANGE,
+    'min_price_NZD': PRICE_RANGE,
+    'min_price_EUR': PRICE_RANGE,
+    'min_price_USL': PRICE_RANGE,
+    'min_price_GBP': PRICE_RANGE,
+    'min_price_AUD': PRICE_RANGE,
+    'min_price_CHF': PRICE_RANGE,
+}
+
+# Hierarchical facets are counted with one pivot facet, the values of
+# 'child' nested within each value of the field.
+PIVOT_FACETS = {
+    'region': {'child': 'country', 'multiselect': True},
 }
 
 DATE_FACETS = {
@@ -51,6 +69,9 @@ DATE_FACETS = {
         'start_date': datetime.datetime.now(),
         'end_date': datetime.datetime.now()+datetime.timedelta(days=365),
         'gap_by': 'month',
+        # count, and narrow windows of at least its max_gap days, on a
+        # CompactDateField of the departures instead
+        # 'range_field': 'departure_ranges',
     },
 
     'return_dates' : {
@@ -60,17 +81,17 @@ DATE_FACETS = {
     },
 }
 
-FACETS_DEFAULT = {'fields':FIELD_FACETS, 'queries': QUERY_FACETS, 'dates':DATE_FACETS}
+FACETS_DEFAULT = {'fields':FIELD_FACETS, 'queries': QUERY_FACETS, 'ranges': RANGE_FACETS, 'dates':DATE_FACETS, 'pivots': PIVOT_FACETS}
                      
 FACETS_ALL = [
     'min_price_CAD', 
-    'min_price_USD'
-    'min_price_NZD'
-    'min_price_EUR'
-    'min_price_USL'
-    'min_price_GBP'
-    'min_price_AUD'
-    'min_price_CHF'
+    'min_price_USD',
+    'min_price_NZD',
+    'min_price_EUR',
+    'min_price_USL',
+    'min_price_GBP',
+    'min_price_AUD',
+    'min_price_CHF',
     'region', 
     'country', 
     'departure_dates', 
@@ -79,17 +100,33 @@ FACETS_ALL = [
     'trip_style', 
     'service_level', 
     'promotion_CAD', 
-    'promotion_USD'
-    'promotion_NZD'
-    'promotion_EUR'
-    'promotion_USL'
-    'promotion_GBP'
-    'promotion_AUD'
-    'promotion_CHF' 
+    'promotion_USD',
+    'promotion_NZD',
+    'promotion_EUR',
+    'promotion_USL',
+    'promotion_GBP',
+    'promotion_AUD',
+    'promotion_CHF',
     'activity',
     'tag',
 ]
 
+# Stored index fields used to render result listings without loading
+# the models. Pass as Searcher(stored_fields=...)
+STORED_RESULT_FIELDS = (
+    'name',
+    'region',
+    'duration',
+    'min_price_CAD',
+    'min_price_USD',
+    'min_price_NZD',
+    'min_price_EUR',
+    'min_price_USL',
+    'min_price_GBP',
+    'min_price_AUD',
+    'min_price_CHF',
+)
+
 FACET_BASE_URL_NAME = 'faceted_trips'
 
 # Optinally defines the order in which selected facets are returned from
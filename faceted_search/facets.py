@@ -7,18 +7,23 @@ from django.conf import settings
 from django.utils.safestring import mark_safe
 
 from currencies.models import Currency
-from faceted_search.utils import is_valid_date_range, parse_date_range
+from faceted_search.cache import get_currency
+from faceted_search.utils import is_valid_date_range, parse_date_range, cached_label
                       
 logger = logging.getLogger(__name__)
 
 FACET_SORT_ORDER = getattr(settings, 'FACET_SORT_ORDER', [])
+# field -> position in FACET_SORT_ORDER, for O(1) lookups when sorting
+FACET_SORT_RANK = dict((field, i) for i, field in reversed(list(enumerate(FACET_SORT_ORDER))))
  
 class FacetList(object):
     '''
     Hybrid List/Dict of Facets. Facets can be looked up
-    by field name O(n)
+    by field name O(n), including the child facets of
+    HierarchicalFacets (e.g. facets['country'] within regions),
+    but only top level facets can be replaced.
     '''
-    def __init__(self, extra_params=None, exclude_params=None):
+    def __init__(self, extra_params=None, exclude_params=None, degraded=False, approximate=False):
         '''
         extra_params
             (key-values) to be added to the url_param
@@ -27,10 +32,17 @@ class FacetList(object):
         exclude_params
             parameters to exclude when calling url_param. Used for ommiting
             implicit parameters from facet URLs
+        degraded
+            True if the facets couldn't be counted in time for this search,
+            and are a previous or related state's facets (or none at all)
+        approximate
+            True if the counts were scaled up from a sample of the results
         '''
         self.facets = []
         self.extra_params = extra_params or {}
         self.exclude_params = exclude_params or []
+        self.degraded = degraded
+        self.approximate = approximate
 
     def append(self, facet):
         facet.facet_set = self
@@ -44,8 +56,8 @@ class FacetList(object):
         for f in self.facets:
             items = items + f.selected_items()
         # Sort the selected facets by the search_settings.FACETS_ALL list index
-        if FACET_SORT_ORDER:
-            return sorted(items, key=lambda f: FACET_SORT_ORDER.index(f.facet.field) if f.facet.field in FACET_SORT_ORDER else 0)
+        if FACET_SORT_RANK:
+            return sorted(items, key=lambda f: FACET_SORT_RANK.get(f.facet.field, 0))
         else:
             return items
     
@@ -71,19 +83,63 @@ class FacetList(object):
             param = self.extra_params.copy()
         
         for item in self.selected_facet_items():
-            if item == facet_item and not include_facet_item:
-                # Our facet item could be selected so exclude it if we are told to
+            if not include_facet_item and (item == facet_item or (facet_item is not None and item.parent == facet_item)):
+                # Our facet item could be selected so exclude it (and its
+                # children) if we are told to
                 continue
 
             if item.facet.field not in self.exclude_params:
-                param.update({item.facet.field: item.value})
+                self._add_param(param, item)
 
         # This is to capture a facet_item that may not be part of our selected items
         if isinstance(facet_item, FacetItem) and include_facet_item and facet_item.facet.field not in self.exclude_params:
-            param.update({facet_item.facet.field: facet_item.value})
+            self._add_param(param, facet_item)
 
-        return urlencode(OrderedDict([k, v.encode('utf-8')] for k, v in param.items()))
+        return urlencode(OrderedDict([k, self._encode_param(v)] for k, v in param.items()), doseq=True)
+
+    @staticmethod
+    def _add_param(param, facet_item):
+        '''
+        Multi-select facets accumulate their values (combined with OR
+        by the Searcher), other facets have a single value per field.
+        Child items of a hierarchical facet also add their parent.
+        '''
+        if facet_item.parent is not None:
+            FacetList._add_param(param, facet_item.parent)
+
+        field = facet_item.facet.field
+        if facet_item.facet.multiselect:
+            values = list(param.get(field, []))
+            if facet_item.value not in values:
+                values.append(facet_item.value)
+            param[field] = values
+        else:
+            param[field] = facet_item.value
+
+    @staticmethod
+    def _encode_param(value):
+        if isinstance(value, (list, tuple)):
+            return [v.encode('utf-8') for v in value]
+        return value.encode('utf-8')
                       
+    def encode(self):
+        '''
+        A compact, tuple based encoding of the facets (not including the
+        extra/exclude params) for caching. See FacetList.decode
+        '''
+        return tuple(f.encode() for f in self.facets)
+
+    @classmethod
+    def decode(cls, data, **kwargs):
+        '''
+        Rebuild a FacetList from FacetList.encode(). kwargs are passed
+        to the constructor (e.g. extra_params)
+        '''
+        facet_list = cls(**kwargs)
+        for facet_data in data:
+            facet_list.append(Facet.decode(facet_data))
+        return facet_list
+
     def get(self, key, default='__NOT_SET__'):
         if default == '__NOT_SET__':
             return self[key]
@@ -97,10 +153,18 @@ class FacetList(object):
         for facet in self.facets:
             if facet.field == key:
                 return facet
+        for facet in self.facets:
+            child = getattr(facet, 'child', None)
+            if child is not None and child.field == key:
+                return child
         raise KeyError(key)
 
     def __setitem__(self, key, value):
-        item = self[key]
+        # Child facets belong to their HierarchicalFacet's items, so only
+        # top level facets can be replaced
+        item = next((facet for facet in self.facets if facet.field == key), None)
+        if item is None:
+            raise KeyError('%s is not a top level facet' % key)
         self.facets.remove(item)
         self.facets.append(value)
 
@@ -131,11 +195,16 @@ class Facet(object):
         Used for URL parameters and matches the field name in the search index
     `label`
         Front-end label displayed on the page
+    `multiselect`
+        Several items may be selected at once, matching any of them (OR)
     '''
-    def __init__(self, field, label, label_plural=None):
+    kind = 'field'
+
+    def __init__(self, field, label, label_plural=None, multiselect=False):
         self.field = field
         self.label = mark_safe(label)
         self.label_plural = label_plural or self._pluralize(field)
+        self.multiselect = multiselect
         self.items = []
         self.facet_set = None
 
@@ -162,6 +231,24 @@ class Facet(object):
             return '%ss' % value       
             
 
+    def encode(self):
+        return (self.kind, self.field, self.label, self.label_plural, self.multiselect,
+                tuple(i.encode() for i in self.items))
+
+    @staticmethod
+    def decode(data):
+        return FACET_KINDS[data[0]].from_data(data)
+
+    @classmethod
+    def from_data(cls, data):
+        kind, field, label, label_plural, multiselect, items = data[:6]
+        facet = cls(field, label, label_plural, multiselect)
+        for item_data in items:
+            item = FacetItem.decode(item_data)
+            item.facet = facet
+            facet.items.append(item)
+        return facet
+
     def sort_by_value(self):
         self.items = sorted(self.items, key=lambda item: item.value)
 
@@ -220,22 +307,87 @@ class QueryFacet(Facet):
     The Facet.sort_by_value screws up the ordering of query based facets,
     which have values that look like:
         [* TO 500], '[500 TO 1000], '[1001 TO 2000], [2001 TO *], etc.
+    or, for range facets, exclusive bounds such as [* TO 500}, {2000 TO *]
 
     '''
+    kind = 'query'
+
     @staticmethod
     def validate_range(value):
         '''
         Determine if the value describes a valid range query
         '''
-        return bool(re.compile("\[.* TO .*\]").match(value))
+        return bool(re.compile("[\[{].* TO .*[\]}]").match(value))
 
     def sort_by_value(self):
         self.items = sorted(self.items, key=lambda item: self._sort_val(item.value))
 
     def _sort_val(self, val):
         '''Returns the numeric value of a query facet for sorting'''
-        sort_val = val.lstrip('[').rstrip(']').split()[0].replace('*', '0') 
-        return int(sort_val)
+        sort_val = val.lstrip('[{').rstrip(']}').split()[0].replace('*', '0') 
+        return float(sort_val)
+
+class HierarchicalFacet(Facet):
+    '''
+    A Facet whose items have nested child items for another field,
+    e.g. countries within regions. Child items belong to `child`, a Facet
+    for the nested field, and are selected together with their parent.
+    '''
+    kind = 'hierarchy'
+
+    def __init__(self, field, label, label_plural=None, multiselect=False,
+                       child_field=None, child_label=None):
+        self.child = Facet(child_field, child_label or child_field.replace('_', ' ').title(),
+                           multiselect=multiselect)
+        super(HierarchicalFacet, self).__init__(field, label, label_plural, multiselect)
+
+    @property
+    def facet_set(self):
+        return self._facet_set
+
+    @facet_set.setter
+    def facet_set(self, value):
+        self._facet_set = value
+        self.child.facet_set = value
+
+    def add_child(self, item, child):
+        child.facet = self.child
+        child.parent = item
+        item.children.append(child)
+        self.child.items.append(child)
+
+    def selected_items(self):
+        return super(HierarchicalFacet, self).selected_items() + self.child.selected_items()
+
+    def has_selected(self):
+        return super(HierarchicalFacet, self).has_selected() or self.child.has_selected()
+
+    def sort_by_value(self):
+        super(HierarchicalFacet, self).sort_by_value()
+        for item in self.items:
+            item.children.sort(key=lambda child: child.value)
+
+    def sort_by_count(self):
+        super(HierarchicalFacet, self).sort_by_count()
+        for item in self.items:
+            item.children.sort(key=lambda child: child.count, reverse=True)
+
+    def encode(self):
+        return super(HierarchicalFacet, self).encode() + (
+            self.child.field, self.child.label,
+            tuple(tuple(c.encode() for c in i.children) for i in self.items))
+
+    @classmethod
+    def from_data(cls, data):
+        kind, field, label, label_plural, multiselect, items, child_field, child_label, children = data
+        facet = cls(field, label, label_plural, multiselect, child_field, child_label)
+        for item_data, child_data in zip(items, children):
+            item = FacetItem.decode(item_data)
+            item.facet = facet
+            facet.items.append(item)
+            for child_item_data in child_data:
+                facet.add_child(item, FacetItem.decode(child_item_data))
+        return facet
 
 class FacetItem(object):
     '''
@@ -254,7 +406,22 @@ class FacetItem(object):
 
         # Date facets might need grouping in the templates
         self.year = getattr(value, 'year', None)
+
+        # Numeric bounds of range facet items, None if open-ended
+        self.start = None
+        self.end = None
+
+        # Nested items of hierarchical facets
+        self.parent = None
+        self.children = []
  
+    @property
+    def approximate(self):
+        '''
+        True if the count is estimated from a sample of the results
+        '''
+        return bool(self.facet and self.facet.facet_set and self.facet.facet_set.approximate)
+
     @property
     def url(self):
         return self._build_url()
@@ -268,19 +435,25 @@ class FacetItem(object):
         return self._build_url(include_self=False)
 
     @staticmethod
+    @cached_label('query')
     def label_from_query(query_value):
         return query_value.replace('[', '').replace(']', '').lower()
 
     @staticmethod
     def price_label_from_query(query_value, currency=None):
         if not isinstance(currency, Currency):
-            currency = Currency.objects.get(code=settings.DEFAULT_CURRENCY_CODE)
+            currency = get_currency()
+        return FacetItem._price_label(query_value, currency.symbol())
 
+    @staticmethod
+    @cached_label('price')
+    def _price_label(query_value, symbol):
         label = FacetItem.label_from_query(query_value).replace('*', str(settings.PRICE_FACET_MAX))
 
-        return ''.join((currency.symbol(),label,))
+        return ''.join((symbol,label,))
 
     @staticmethod
+    @cached_label('date_range')
     def date_label_from_query(query_value):
         DATE_DISPLAY_FORMAT = '%b %e, %Y'
 
@@ -290,6 +463,18 @@ class FacetItem(object):
 
         return query_value
 
+    def encode(self):
+        label = self.label if self.label != self.value else None
+        return (self.value, self.count, label, self.is_selected, self.base_url,
+                self.year, self.start, self.end)
+
+    @classmethod
+    def decode(cls, data):
+        value, count, label, is_selected, base_url, year, start, end = data
+        item = cls(value, count, label, is_selected, base_url)
+        item.year, item.start, item.end = year, start, end
+        return item
+
     def is_range(self):
         '''
         Determine if the FacetItem describes a range query
@@ -325,4 +510,5 @@ class FacetItem(object):
 
     def __str__(self):
         return self.__unicode__()
-         
+
+FACET_KINDS = dict((f.kind, f) for f in (Facet, QueryFacet, HierarchicalFacet))
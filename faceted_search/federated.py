@@ -0,0 +1,110 @@
+import logging
+from collections import OrderedDict
+
+from django.conf import settings
+
+from haystack.query import EmptySearchQuerySet
+
+from faceted_search.searcher import Searcher, Search, KEYWORD_PARAM
+from faceted_search.utils import run_parallel
+
+logger = logging.getLogger(__name__)
+
+# Results fetched up front for each model, so that the result queries run
+# concurrently too
+FEDERATED_RESULTS = getattr(settings, 'FACET_FEDERATED_RESULTS', 10)
+
+
+class FederatedSearch(object):
+    '''
+    The Searches of a FederatedSearcher.search(), by model name
+    '''
+    def __init__(self, searches):
+        self.searches = searches
+
+    def __getitem__(self, name):
+        return self.searches[name]
+
+    def __iter__(self):
+        return iter(self.searches.items())
+
+    @property
+    def facets(self):
+        return OrderedDict((name, search.facets) for name, search in self.searches.items())
+
+    @property
+    def hit_counts(self):
+        return OrderedDict((name, search.hit_count) for name, search in self.searches.items())
+
+    @property
+    def hit_count(self):
+        return sum(count for count in self.hit_counts.values() if count)
+
+
+class FederatedSearcher(object):
+    '''
+    Searches several models at once, each with its own Searcher (facet
+    and sort config), so a site search takes as long as the slowest model
+    rather than all of them in turn.
+
+        searcher = FederatedSearcher([
+            Searcher(model=Trip, facets=TRIP_FACETS),
+            (Destination, DESTINATION_FACETS),
+        ])
+        search = searcher.search(request.GET)
+        search['trip'].facets, search.hit_counts
+
+    A filter on a field that some of the models facet on but another
+    doesn't (e.g. region=Asia for trips but not articles) matches none of
+    the other model's documents: its Search is empty, with a hit count of
+    0, and no backend request is sent for it. Filters on fields none of
+    the models facet on are ignored.
+    '''
+    def __init__(self, searchers, results=FEDERATED_RESULTS, **searcher_kwargs):
+        '''
+        searchers
+            Searchers or (model, facets) pairs, for which Searchers are
+            built with searcher_kwargs
+        results
+            the number of results fetched for each model with the facets
+        '''
+        self.searchers = OrderedDict()
+        for searcher in searchers:
+            if not isinstance(searcher, Searcher):
+                model, facets = searcher
+                searcher = Searcher(model=model, facets=facets, **searcher_kwargs)
+            self.searchers[searcher.model._meta.model_name] = searcher
+        self.results = results
+        self.facet_fields = dict((name, self._facet_fields(searcher)) for name, searcher in self.searchers.items())
+        self.all_facet_fields = set().union(*self.facet_fields.values())
+
+    def search(self, filters=None, keywords=None, **kwargs):
+        filters = filters or {}
+        names = self.searchers.keys()
+        searches = run_parallel(lambda name: self._search(name, filters, keywords, **kwargs), names, len(names))
+        return FederatedSearch(OrderedDict(zip(names, searches)))
+
+    def _search(self, name, filters, keywords=None, **kwargs):
+        model_filters = dict((f, v) for f, v in filters.items() if f in self.facet_fields[name] or f == KEYWORD_PARAM)
+        filtered = set(f for f, v in filters.items() if f in self.all_facet_fields and self._has_value(v))
+        if filtered - self.facet_fields[name]:
+            search = Search(self.searchers[name], model_filters, keywords, search_kwargs=kwargs)
+            search.queryset = EmptySearchQuerySet()
+            search.hit_count = 0
+            return search
+
+        search = self.searchers[name].search(model_filters, keywords, **kwargs)
+        if self.results:
+            # Fills the queryset's result cache
+            list(search.queryset[:self.results])
+        return search
+
+    def _has_value(self, value):
+        if isinstance(value, (list, tuple)):
+            return any(value)
+        return bool(value)
+
+    def _facet_fields(self, searcher):
+        fields = set(searcher.facet_labels)
+        fields.update(conf['child'] for conf in searcher.pivot_facets.values())
+        return fields
@@ -1,8 +1,46 @@
+import zlib
 import datetime
 from django.utils import datetime_safe
 from haystack import indexes
+from haystack.exceptions import SearchFieldError
 
 from faceted_search.utils import DATETIME_REGEX
+
+# Buckets of SampleField
+SAMPLE_BUCKETS = 100
+
+# Dates parsed from strings, shared by all objects indexed by this process.
+# Departure dates repeat across many trips, so most lookups are hits.
+_parsed_dates = {}
+PARSED_DATES_MAX = 10000
+
+def parse_date(value):
+    '''
+    The date of a 'YYYY-MM-DD HH:MM:SS' (or 'T' separated) string, or None
+    if it isn't one. The common format is sliced rather than matched with
+    DATETIME_REGEX, and results are memoized.
+    '''
+    try:
+        return _parsed_dates[value]
+    except KeyError:
+        pass
+
+    if len(value) >= 19 and value[4] == value[7] == '-' and value[10] in 'T ' and value[13] == value[16] == ':':
+        try:
+            date = datetime_safe.date(int(value[:4]), int(value[5:7]), int(value[8:10]))
+        except ValueError:
+            return None
+    else:
+        match = DATETIME_REGEX.search(value)
+        if not match:
+            return None
+        data = match.groupdict()
+        date = datetime_safe.date(int(data['year']), int(data['month']), int(data['day']))
+
+    if len(_parsed_dates) >= PARSED_DATES_MAX:
+        _parsed_dates.clear()
+    _parsed_dates[value] = date
+    return date
  
 class MultiValueDateField(indexes.MultiValueField):
     '''
@@ -11,6 +49,9 @@ class MultiValueDateField(indexes.MultiValueField):
     This class is mostly responsible for converting an indexed date from a string
     to a python date. Note that build_solr_schema will still create a multi valued text
     field which must be manually changed to the date type.
+
+    For large indexes, prepare and send documents in parallel batches with
+    haystack's `update_index --workers N --batch-size B`.
     '''
     def prepare(self, obj):
         return self.convert(super(MultiValueDateField, self).prepare(obj))
@@ -22,16 +63,80 @@ class MultiValueDateField(indexes.MultiValueField):
         dates = []
         for list_value in value:
             if isinstance(list_value, basestring):
-                match = DATETIME_REGEX.search(list_value)
-                if match:
-                    data = match.groupdict()
-                    dates.append(datetime_safe.date(int(data['year']), int(data['month']), int(data['day'])))
-                else:
+                date = parse_date(list_value)
+                if date is None:
                     raise SearchFieldError("Date provided to '%s' field doesn't appear to be a valid date string: '%s'" % (self.instance_name, list_value))
+                dates.append(date)
             elif isinstance(list_value, datetime.date):
                 dates.append(list_value)
             else:
                 raise SearchFieldError("Date provided to '%s' field doesn't appear to be a valid date: '%s'" % (self.instance_name, list_value))
 
-        return list(dates)   
-                         
+        return dates
+
+def compress_dates(dates, max_gap=7):
+    '''
+    Compresses dates into Solr DateRangeField values: runs of dates at
+    most max_gap days apart become one range, single dates stay as is.
+
+    >>> compress_dates([date(2014, 5, 3), date(2014, 5, 10), date(2014, 5, 17), date(2014, 8, 1)])
+    ['[2014-05-03 TO 2014-05-17]', '2014-08-01']
+    '''
+    values = []
+    run = []
+    for date in sorted(set(dates)):
+        if run and (date - run[-1]).days > max_gap:
+            values.append(_date_range_value(run))
+            run = []
+        run.append(date)
+    if run:
+        values.append(_date_range_value(run))
+    return values
+
+def _date_range_value(run):
+    if len(run) == 1:
+        return run[0].strftime('%Y-%m-%d')
+    return '[%s TO %s]' % (run[0].strftime('%Y-%m-%d'), run[-1].strftime('%Y-%m-%d'))
+
+class CompactDateField(MultiValueDateField):
+    '''
+    Indexes a list of dates (e.g. departures) as a few date ranges rather
+    than one value per date: runs of dates no more than max_gap days apart
+    are indexed as one range, so weekly departures from March to October
+    are a single value. The field must be changed to a multi valued
+    solr.DateRangeField in the schema.
+
+    Any window of at least max_gap days (e.g. a month) that intersects a
+    range contains one of its dates, so month facets and narrows to
+    windows that long are exact. Shorter windows (e.g. a single day, or
+    2014-03-02 to 2014-03-04 within a weekly run) can fall between two
+    departures, so the Searcher narrows those on the date facet's own
+    field, which must still be indexed. Use it with the 'range_field'
+    option of a date facet (see Searcher). The ranges aren't stored, as
+    they wouldn't convert back to dates.
+    '''
+    def __init__(self, max_gap=7, **kwargs):
+        kwargs.setdefault('stored', False)
+        super(CompactDateField, self).__init__(**kwargs)
+        self.max_gap = max_gap
+
+    def prepare(self, obj):
+        dates = super(CompactDateField, self).prepare(obj)
+        if dates is None:
+            return None
+        return compress_dates(dates, self.max_gap)
+
+class SampleField(indexes.IntegerField):
+    '''
+    A stable pseudo-random bucket (0 to SAMPLE_BUCKETS - 1) of each
+    document, from a hash of its primary key, so that a range of buckets
+    is the same deterministic sample of any result set. Used to count
+    facets approximately for very large result sets (see the Searcher's
+    approximate_threshold).
+    '''
+    def __init__(self, **kwargs):
+        kwargs.setdefault('stored', False)
+        super(SampleField, self).__init__(**kwargs)
+
+    def prepare(self, obj):
+        return zlib.crc32(unicode(obj.pk).encode('utf-8')) % SAMPLE_BUCKETS
@@ -0,0 +1,191 @@
+'''
+Targeted invalidation of the facet cache as documents are indexed and
+removed, rather than flushing it or waiting for entries to expire.
+
+Cached facets are stored with the version of their state: the counters of
+the version keys the state depends on. A filter on an exact valued facet
+(e.g. region=Asia) depends on the counters of its values, a filter on a
+range facet (prices, dates) on its field's counter, and every state on its
+model's counter. When a document is indexed, the facet field values it had
+when last indexed are compared with its new ones and, if they differ, only
+the counters of those values (old and new) are bumped. So editing a trip
+in Peru invalidates the states filtered on Peru (or on the trip's other
+values), unfiltered states and keyword states, but not those of Asia.
+Values of fields that aren't faceted aren't recorded, so states filtered
+on them (like keyword states) are invalidated by any indexed document.
+
+Enabled by settings.FACET_CACHE_INVALIDATION with a facet cache; the Solr
+backend reports updates with the documents it indexed (see
+FacetedSolrSearchBackend).
+'''
+import logging
+
+from django.conf import settings
+
+from haystack.constants import ID, DJANGO_CT
+from haystack.utils import get_identifier, get_model_ct
+
+from faceted_search.cache import make_cache_key, facet_cache as default_facet_cache
+
+logger = logging.getLogger(__name__)
+
+FACET_CACHE_INVALIDATION = getattr(settings, 'FACET_CACHE_INVALIDATION', False)
+# Updates of more documents than this (e.g. update_index batches)
+# invalidate all of the model's states rather than comparing values
+FACET_CACHE_INVALIDATION_BATCH = getattr(settings, 'FACET_CACHE_INVALIDATION_BATCH', 100)
+
+# Version key parts besides field names
+INDEX = '__index__'
+ANY_VALUE = '__any__'
+KEYWORDS = '__keywords__'
+UNRECORDED = '__unrecorded__'
+
+
+def version_key(model_ct, *parts):
+    return make_cache_key('facet_version', model_ct, *parts)
+
+
+def state_version_keys(model_ct, filters, keywords, exact_fields, recorded_fields, multiselect_fields=()):
+    '''
+    The version keys a facet state depends on.
+
+    model_ct
+        'app_label.model_name' of the searched model, or None
+    filters
+        the cleaned filters of the state
+    exact_fields
+        fields whose filter values are the indexed values (field facets)
+        rather than ranges
+    recorded_fields
+        fields whose values are compared when documents change (faceted
+        fields); filters on other fields depend on any change
+    multiselect_fields
+        fields whose filters don't restrict their own facet's counts, so
+        don't limit the documents the state depends on
+    '''
+    keys = [version_key(None, INDEX), version_key(model_ct)]
+    restricting = sorted((field, value) for field, value in filters.iteritems() if field not in multiselect_fields)
+    if not restricting:
+        keys.append(version_key(model_ct, ANY_VALUE))
+    for field, value in restricting:
+        values = value if isinstance(value, (list, tuple)) else [value]
+        if field not in recorded_fields:
+            keys.append(version_key(model_ct, UNRECORDED))
+        elif field in exact_fields:
+            keys.extend(version_key(model_ct, field, unicode(v)) for v in sorted(values))
+        else:
+            keys.append(version_key(model_ct, field))
+    if keywords:
+        keys.append(version_key(model_ct, KEYWORDS))
+    return sorted(set(keys))
+
+
+class FacetCacheInvalidator(object):
+    '''
+    Keeps the version counters of facet states in the facet cache's Django
+    cache, along with the facet field values each document was last
+    indexed with.
+    '''
+    def __init__(self, facet_cache, batch_size=FACET_CACHE_INVALIDATION_BATCH):
+        self.facet_cache = facet_cache
+        self.batch_size = batch_size
+
+    @property
+    def cache(self):
+        return self.facet_cache.cache
+
+    def version(self, keys):
+        '''
+        The version of a state depending on the given version keys
+        '''
+        counters = self.cache.get_many(keys)
+        return tuple(counters.get(key, 0) for key in keys)
+
+    def bump(self, keys):
+        for key in keys:
+            try:
+                self.cache.incr(key)
+            except ValueError:
+                self.cache.set(key, 1, None)
+
+    def document_values(self, index, prepared):
+        '''
+        The facet field values of a document prepared by index (see
+        SearchIndex.full_prepare), as sorted lists of strings
+        '''
+        values = {}
+        for field in index.fields.values():
+            if not field.faceted:
+                continue
+            value = prepared.get(field.index_fieldname)
+            value = value if isinstance(value, (list, tuple, set)) else [value]
+            values[field.index_fieldname] = sorted(set(unicode(v) for v in value if v is not None))
+        return values
+
+    def updated(self, index, docs):
+        '''
+        Invalidates the states affected by indexing docs, the documents
+        as prepared by index for the backend
+        '''
+        if not docs:
+            return
+        if len(docs) > self.batch_size:
+            model_cts = set(doc[DJANGO_CT] for doc in docs)
+            self.bump([version_key(model_ct) for model_ct in model_cts] + [version_key(None)])
+            self.cache.delete_many([self._record_key(doc[ID]) for doc in docs])
+            return
+
+        record_keys = [self._record_key(doc[ID]) for doc in docs]
+        before = self.cache.get_many(record_keys)
+        after = {}
+        keys = set()
+        for doc, record_key in zip(docs, record_keys):
+            values = self.document_values(index, doc)
+            keys.update(self._changed_keys(doc[DJANGO_CT], before.get(record_key), values))
+            after[record_key] = values
+        self.bump(keys)
+        self.cache.set_many(after, None)
+
+    def removed(self, obj_or_string):
+        identifier = get_identifier(obj_or_string)
+        record_key = self._record_key(identifier)
+        model_ct = '.'.join(identifier.split('.')[:2])
+        self.bump(self._changed_keys(model_ct, self.cache.get(record_key), {}))
+        self.cache.delete(record_key)
+
+    def cleared(self, models=None):
+        if not models:
+            self.bump([version_key(None, INDEX)])
+        else:
+            self.bump([version_key(get_model_ct(model)) for model in models] + [version_key(None)])
+
+    def _changed_keys(self, model_ct, before, after):
+        '''
+        The version keys to bump for a document whose facet field values
+        were before and are after (None if unknown)
+        '''
+        keys = set()
+        for ct in (model_ct, None):
+            # The document may have started or stopped matching keywords,
+            # or filters on fields whose values aren't recorded
+            keys.add(version_key(ct, KEYWORDS))
+            keys.add(version_key(ct, UNRECORDED))
+            if before is None or after is None:
+                keys.add(version_key(ct))
+                continue
+            if before == after:
+                continue
+            keys.add(version_key(ct, ANY_VALUE))
+            for field in set(before) | set(after):
+                keys.add(version_key(ct, field))
+                for value in set(before.get(field, ())) | set(after.get(field, ())):
+                    keys.add(version_key(ct, field, value))
+        return keys
+
+    def _record_key(self, identifier):
+        return make_cache_key('facet_document', identifier)
+
+
+default_invalidator = None
+if FACET_CACHE_INVALIDATION and default_facet_cache is not None:
+    default_invalidator = FacetCacheInvalidator(default_facet_cache)
@@ -0,0 +1,261 @@
+'''
+Replays recorded searches through the full view path (URL resolving, the
+view, the Searcher, facet URL generation and the template tags) with many
+concurrent clients, reporting throughput, latency percentiles and the time
+spent in each phase. Intended to be run against the stub backend
+(faceted_search.backends.stub_backend) so that it works offline; see the
+faceted_search_loadtest management command.
+
+ApproximateBenchmark compares approximate facet counts with exact ones;
+it needs a real index, see the faceted_search_approximate_benchmark
+management command.
+'''
+import json
+import math
+import time
+import threading
+from urllib import urlencode
+
+from django.template.base import Template
+from django.http import QueryDict
+from django.test import Client
+
+from faceted_search.facets import FacetList
+from faceted_search.searcher import Searcher, FACET_SAMPLE_RATE
+
+# Methods timed per phase. Times are exclusive: a phase's time excludes the
+# phases nested within it, e.g. 'facets' doesn't include 'backend'.
+PHASES = (
+    ('search', Searcher, 'search'),
+    ('facets', Searcher, '_facets'),
+    ('urls', FacetList, 'url_param'),
+    ('render', Template, 'render'),
+)
+BACKEND_PHASE = 'backend'
+
+
+def read_recorded(path):
+    '''
+    Reads recorded searches, one per line, either as a JSON object of
+    parameters or a raw query string (e.g. from an access log).
+    '''
+    searches = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                line = urlencode(json.loads(line), doseq=True)
+            searches.append(line.lstrip('?'))
+    return searches
+
+
+def percentile(values, percent):
+    '''
+    The nearest-rank percentile of a list of values
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class PhaseTimer(object):
+    '''
+    Times the PHASES methods (and the backend's search) of each thread's
+    current request by wrapping them for the duration of a load test.
+    '''
+    def __init__(self, backend_class=None):
+        self.phases = list(PHASES)
+        if backend_class is not None:
+            self.phases.append((BACKEND_PHASE, backend_class, 'search'))
+        self.local = threading.local()
+        self.originals = []
+
+    def start_request(self):
+        self.local.times = dict((name, 0.0) for name, cls, method in self.phases)
+        self.local.stack = []
+
+    def request_times(self):
+        return self.local.times
+
+    def install(self):
+        for name, cls, method in self.phases:
+            original = cls.__dict__[method]
+            self.originals.append((cls, method, original))
+            setattr(cls, method, self._timed(name, original))
+
+    def uninstall(self):
+        for cls, method, original in reversed(self.originals):
+            setattr(cls, method, original)
+        self.originals = []
+
+    def _timed(self, name, func):
+        timer = self
+        def timed(*args, **kwargs):
+            stack = getattr(timer.local, 'stack', None)
+            if stack is None:
+                return func(*args, **kwargs)
+            # [name, time spent in nested phases]
+            stack.append([name, 0.0])
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - started
+                nested = stack.pop()[1]
+                timer.local.times[name] += elapsed - nested
+                if stack:
+                    stack[-1][1] += elapsed
+        return timed
+
+
+class LoadTest(object):
+    '''
+    Runs each of the recorded searches (query strings) against url,
+    `repeat` times over, with `clients` concurrent clients.
+    '''
+    def __init__(self, url, searches, clients=10, repeat=1, backend_class=None):
+        self.url = url
+        self.searches = searches
+        self.clients = clients
+        self.repeat = repeat
+        self.timer = PhaseTimer(backend_class)
+        self.results = []
+        self.lock = threading.Lock()
+
+    def run(self):
+        queue = list(reversed(self.searches * self.repeat))
+        threads = [threading.Thread(target=self._client, args=(queue,)) for i in range(self.clients)]
+        self.timer.install()
+        started = time.time()
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.elapsed = time.time() - started
+            self.timer.uninstall()
+        return self.report()
+
+    def _client(self, queue):
+        client = Client()
+        while True:
+            with self.lock:
+                if not queue:
+                    return
+                query_string = queue.pop()
+            self.timer.start_request()
+            started = time.time()
+            try:
+                status = client.get(self.url, QUERY_STRING=query_string).status_code
+            except Exception:
+                status = None
+            elapsed = time.time() - started
+            with self.lock:
+                self.results.append((status, elapsed, self.timer.request_times()))
+
+    def report(self):
+        '''
+        Throughput, latency percentiles (seconds) and mean/p95 per phase
+        '''
+        latencies = [elapsed for status, elapsed, times in self.results]
+        phases = {}
+        for name, cls, method in self.timer.phases:
+            times = [t[name] for status, elapsed, t in self.results]
+            phases[name] = {'mean': sum(times) / len(times) if times else None, 'p95': percentile(times, 95)}
+        # Time outside the timed phases, e.g. middleware and the view itself
+        other = [elapsed - sum(t.values()) for status, elapsed, t in self.results]
+        phases['other'] = {'mean': sum(other) / len(other) if other else None, 'p95': percentile(other, 95)}
+
+        return {
+            'requests': len(self.results),
+            'errors': len([r for r in self.results if r[0] != 200]),
+            'clients': self.clients,
+            'elapsed': self.elapsed,
+            'throughput': len(self.results) / self.elapsed if self.elapsed else None,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'phases': phases,
+        }
+
+
+def facet_count_errors(exact, approximate):
+    '''
+    The relative errors of the approximate counts of the items counted in
+    the exact FacetList, and the number of those items the approximate
+    FacetList is missing.
+    '''
+    approximate_counts = dict(((facet.field, item.value), item.count) for facet in approximate for item in facet.items)
+    errors = []
+    missing = 0
+    for facet in exact:
+        for item in facet.items:
+            if not item.count:
+                continue
+            count = approximate_counts.get((facet.field, item.value))
+            if not count:
+                missing += 1
+            else:
+                errors.append(abs(count - item.count) / float(item.count))
+    return errors, missing
+
+
+class ApproximateBenchmark(object):
+    '''
+    Fetches the facets of each recorded search (query strings) exactly and
+    approximately (counted over a sample_rate sample), uncached and
+    `repeat` times over, reporting the fastest time of each, the speedup
+    and the relative error of the approximate counts.
+    '''
+    def __init__(self, model, facets, searches, repeat=3, sample_rate=FACET_SAMPLE_RATE):
+        options = dict(model=model, facets=facets, facet_cache=None, prefetcher=None, query_log=None,
+                       facet_time_budget=None)
+        self.exact = Searcher(approximate_threshold=None, **options)
+        self.approximate = Searcher(approximate_threshold=0, sample_rate=sample_rate, **options)
+        self.searches = searches
+        self.repeat = repeat
+
+    def run(self):
+        exact_times = []
+        approximate_times = []
+        errors = []
+        missing = 0
+        for query_string in self.searches:
+            filters = dict(QueryDict(query_string).lists())
+            exact, elapsed = self._time(self.exact, filters)
+            exact_times.append(elapsed)
+            approximate, elapsed = self._time(self.approximate, filters)
+            approximate_times.append(elapsed)
+            search_errors, search_missing = facet_count_errors(exact, approximate)
+            errors += search_errors
+            missing += search_missing
+
+        exact_mean = sum(exact_times) / len(exact_times) if exact_times else None
+        approximate_mean = sum(approximate_times) / len(approximate_times) if approximate_times else None
+        return {
+            'searches': len(self.searches),
+            'exact': {'mean': exact_mean, 'p95': percentile(exact_times, 95)},
+            'approximate': {'mean': approximate_mean, 'p95': percentile(approximate_times, 95)},
+            'speedup': exact_mean / approximate_mean if approximate_mean else None,
+            'error': {
+                'mean': sum(errors) / len(errors) if errors else None,
+                'p95': percentile(errors, 95),
+                'max': max(errors) if errors else None,
+            },
+            'items': len(errors) + missing,
+            'missing': missing,
+        }
+
+    def _time(self, searcher, filters):
+        best = None
+        for i in range(self.repeat):
+            started = time.time()
+            facets = searcher.prefetch_facets(filters)
+            elapsed = time.time() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return facets, best
@@ -0,0 +1,59 @@
+import json
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from faceted_search.apps import FACET_CONFIG_SETTINGS
+from faceted_search.loadtest import ApproximateBenchmark, read_recorded
+from faceted_search.searcher import FACET_SAMPLE_RATE
+
+
+class Command(BaseCommand):
+    help = ('Fetches the facets of recorded searches (a file of JSON objects or query strings, one '
+            'per line) exactly and counted over a sample, and reports the speedup and the error of '
+            'the approximate counts. Needs a real index with a SampleField.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='indexed model, e.g. trips.Trip')
+        parser.add_argument('recorded', help='file of recorded searches')
+        parser.add_argument('--facets', default=FACET_CONFIG_SETTINGS[0], help='setting holding the facet config')
+        parser.add_argument('--sample-rate', type=float, default=FACET_SAMPLE_RATE, help='fraction of results sampled')
+        parser.add_argument('--repeat', type=int, default=3, help='times to fetch each search (the fastest counts)')
+        parser.add_argument('--json', action='store_true', help='output the report as JSON')
+
+    def handle(self, model, recorded, **options):
+        try:
+            model_class = apps.get_model(model)
+        except (LookupError, ValueError) as e:
+            raise CommandError('Unknown model %s: %s' % (model, e))
+        if not hasattr(settings, options['facets']):
+            raise CommandError('No facet config setting %s' % options['facets'])
+        try:
+            searches = read_recorded(recorded)
+        except (IOError, ValueError) as e:
+            raise CommandError('Cannot read recorded searches from %s: %s' % (recorded, e))
+        if not searches:
+            raise CommandError('No recorded searches in %s' % recorded)
+
+        report = ApproximateBenchmark(model_class, getattr(settings, options['facets']), searches,
+                                      repeat=options['repeat'], sample_rate=options['sample_rate']).run()
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write('%d searches, sample rate %s' % (report['searches'], options['sample_rate']))
+        self.stdout.write('Exact:       mean %s, p95 %s' % (self._ms(report['exact']['mean']), self._ms(report['exact']['p95'])))
+        self.stdout.write('Approximate: mean %s, p95 %s' % (self._ms(report['approximate']['mean']),
+                                                          self._ms(report['approximate']['p95'])))
+        self.stdout.write('Speedup: %s' % ('%.1fx' % report['speedup'] if report['speedup'] else '-'))
+        self.stdout.write('Count error: mean %s, p95 %s, max %s' % tuple(
+            self._percent(report['error'][k]) for k in ('mean', 'p95', 'max')))
+        self.stdout.write('Items missing from the sample: %(missing)d of %(items)d' % report)
+
+    def _ms(self, seconds):
+        return '%.1fms' % (seconds * 1000) if seconds is not None else '-'
+
+    def _percent(self, fraction):
+        return '%.1f%%' % (fraction * 100) if fraction is not None else '-'
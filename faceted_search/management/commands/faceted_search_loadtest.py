@@ -0,0 +1,48 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from haystack import connections
+
+from faceted_search.loadtest import LoadTest, read_recorded
+
+
+class Command(BaseCommand):
+    help = ('Replays recorded searches (a file of JSON objects or query strings, one per line) '
+            'against a search view with concurrent clients and reports throughput, latency '
+            'percentiles and a per-phase breakdown. Use the stub backend to run offline.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='path of the search view, e.g. /trips/')
+        parser.add_argument('recorded', help='file of recorded searches')
+        parser.add_argument('--clients', type=int, default=10, help='concurrent clients')
+        parser.add_argument('--repeat', type=int, default=1, help='times to replay each search')
+        parser.add_argument('--using', default='default', help='haystack connection (for backend timing)')
+        parser.add_argument('--json', action='store_true', help='output the report as JSON')
+
+    def handle(self, url, recorded, **options):
+        try:
+            searches = read_recorded(recorded)
+        except (IOError, ValueError) as e:
+            raise CommandError('Cannot read recorded searches from %s: %s' % (recorded, e))
+        if not searches:
+            raise CommandError('No recorded searches in %s' % recorded)
+
+        backend_class = connections[options['using']].get_backend().__class__
+        report = LoadTest(url, searches, clients=options['clients'], repeat=options['repeat'],
+                          backend_class=backend_class).run()
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write('%(requests)d requests (%(errors)d errors) with %(clients)d clients in %(elapsed).2fs' % report)
+        self.stdout.write('Throughput: %.1f requests/s' % report['throughput'])
+        self.stdout.write('Latency: p50 %s, p95 %s, p99 %s' % tuple(
+            self._ms(report[p]) for p in ('p50', 'p95', 'p99')))
+        self.stdout.write('Phase       mean       p95')
+        for name, times in sorted(report['phases'].items(), key=lambda p: -(p[1]['mean'] or 0)):
+            self.stdout.write('%-8s %9s %9s' % (name, self._ms(times['mean']), self._ms(times['p95'])))
+
+    def _ms(self, seconds):
+        return '%.1fms' % (seconds * 1000) if seconds is not None else '-'
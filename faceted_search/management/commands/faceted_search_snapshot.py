@@ -0,0 +1,50 @@
+from django.apps import apps
+from django.conf import settings
+from django.http import QueryDict
+from django.core.management.base import BaseCommand, CommandError
+
+from faceted_search.apps import FACET_CONFIG_SETTINGS
+from faceted_search.loadtest import read_recorded
+from faceted_search.searcher import Searcher, KEYWORD_PARAM
+from faceted_search.snapshot import FACET_SNAPSHOT, build_snapshot, read_query_log
+
+
+class Command(BaseCommand):
+    help = ('Fetches the facets of hot filter states (the most frequent states of a query log, or '
+            'a file of JSON objects or query strings, one per line) and writes them to a facet '
+            'snapshot, replacing the previous one atomically. Run it periodically, e.g. from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='indexed model, e.g. trips.Trip')
+        parser.add_argument('states', help='query log or file of filter states')
+        parser.add_argument('--query-log', action='store_true', help='states is a query log (FACET_QUERY_LOG)')
+        parser.add_argument('--top', type=int, default=1000, help='most frequent query log states included')
+        parser.add_argument('--path', default=FACET_SNAPSHOT, help='snapshot path (default FACET_SNAPSHOT)')
+        parser.add_argument('--facets', default=FACET_CONFIG_SETTINGS[0], help='setting holding the facet config')
+        parser.add_argument('--workers', type=int, default=4, help='concurrent backend requests')
+
+    def handle(self, model, states, **options):
+        if not options['path']:
+            raise CommandError('No snapshot path, set FACET_SNAPSHOT or use --path')
+        try:
+            model_class = apps.get_model(model)
+        except (LookupError, ValueError) as e:
+            raise CommandError('Unknown model %s: %s' % (model, e))
+        if not hasattr(settings, options['facets']):
+            raise CommandError('No facet config setting %s' % options['facets'])
+
+        try:
+            if options['query_log']:
+                filter_states = read_query_log(states, options['top'], model_class._meta.db_table)
+            else:
+                filter_states = []
+                for query_string in read_recorded(states):
+                    filters = dict(QueryDict(query_string).lists())
+                    filter_states.append((filters, ' '.join(filters.pop(KEYWORD_PARAM, []))))
+        except (IOError, ValueError) as e:
+            raise CommandError('Cannot read filter states from %s: %s' % (states, e))
+
+        searcher = Searcher(model=model_class, facets=getattr(settings, options['facets']), snapshot=None,
+                            prefetcher=None, query_log=None, facet_time_budget=None)
+        count = build_snapshot(searcher, filter_states, options['path'], options['workers'])
+        self.stdout.write('Wrote %d states to %s' % (count, options['path']))
@@ -0,0 +1,95 @@
+import logging
+import threading
+import Queue
+from cgi import parse_qs
+
+from django.conf import settings
+
+from faceted_search.cache import make_cache_key
+
+logger = logging.getLogger(__name__)
+
+# Prefetch facets of likely next states after each search (requires a facet cache)
+FACET_PREFETCH = getattr(settings, 'FACET_PREFETCH', False)
+# How many next states to prefetch per search
+FACET_PREFETCH_STATES = getattr(settings, 'FACET_PREFETCH_STATES', 3)
+# Facets whose items are considered, None for all of them
+FACET_PREFETCH_FIELDS = getattr(settings, 'FACET_PREFETCH_FIELDS', None)
+# Number of background threads, i.e. the most concurrent prefetch requests
+FACET_PREFETCH_WORKERS = getattr(settings, 'FACET_PREFETCH_WORKERS', 2)
+# States waiting to be fetched, further states are dropped rather than queued
+FACET_PREFETCH_MAX_PENDING = getattr(settings, 'FACET_PREFETCH_MAX_PENDING', 50)
+
+class FacetPrefetcher(object):
+    '''
+    After a search, fetches the facets of the most likely next states in the
+    background so that they are already in the facet cache when the user
+    clicks. The next states are the current filters plus each of the top
+    (by count) unselected items of the configured facets.
+
+    The extra backend load is capped by the number of states per search,
+    the number of worker threads, and the number of pending states.
+    '''
+    def __init__(self, states=FACET_PREFETCH_STATES, fields=FACET_PREFETCH_FIELDS,
+                       workers=FACET_PREFETCH_WORKERS, max_pending=FACET_PREFETCH_MAX_PENDING):
+        self.states = states
+        self.fields = fields
+        self.workers = workers
+        self.queue = Queue.Queue(max_pending)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def next_states(self, search):
+        '''
+        Filters for the most likely next states after a search
+        '''
+        candidates = []
+        for facet in search.facets:
+            if self.fields is not None and facet.field not in self.fields:
+                continue
+            candidates.extend(i for i in facet.items if not i.is_selected and i.count > 0)
+        candidates.sort(key=lambda item: item.count, reverse=True)
+        return [parse_qs(search.facets.url_param(facet_item=item)) for item in candidates[:self.states]]
+
+    def schedule(self, searcher, search):
+        if searcher.facet_cache is None:
+            return
+        self._start()
+        for filters in self.next_states(search):
+            key = make_cache_key('prefetch', searcher.model and searcher.model._meta.db_table,
+                                 filters, search.search_kwargs)
+            with self.lock:
+                if key in self.pending:
+                    continue
+                try:
+                    self.queue.put_nowait((key, searcher, filters, search.search_kwargs))
+                except Queue.Full:
+                    logger.debug('Facet prefetch queue is full, dropping %s' % filters)
+                    return
+                self.pending.add(key)
+
+    def _start(self):
+        if self.threads:
+            return
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work, name='facet-prefetch-%d' % len(self.threads))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            key, searcher, filters, kwargs = self.queue.get()
+            try:
+                # Facets are only fetched on a cache miss
+                searcher.prefetch_facets(filters, **kwargs)
+            except Exception:
+                logger.exception('Facet prefetch failed for %s' % filters)
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+                self.queue.task_done()
+
+default_prefetcher = FacetPrefetcher() if FACET_PREFETCH else None
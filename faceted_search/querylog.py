@@ -0,0 +1,123 @@
+import json
+import random
+import logging
+import logging.handlers
+import threading
+import Queue
+from datetime import datetime
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Path of a JSONL file to log searches to, rotated at FACET_QUERY_LOG_MAX_BYTES
+FACET_QUERY_LOG = getattr(settings, 'FACET_QUERY_LOG', None)
+# Or the dotted path of a sink class, called with the constructor kwargs
+# FACET_QUERY_LOG_SINK_OPTIONS, whose write(records) is given lists of dicts
+FACET_QUERY_LOG_SINK = getattr(settings, 'FACET_QUERY_LOG_SINK', None)
+FACET_QUERY_LOG_SINK_OPTIONS = getattr(settings, 'FACET_QUERY_LOG_SINK_OPTIONS', {})
+# Fraction of searches logged
+FACET_QUERY_LOG_SAMPLE_RATE = getattr(settings, 'FACET_QUERY_LOG_SAMPLE_RATE', 1.0)
+FACET_QUERY_LOG_MAX_BYTES = getattr(settings, 'FACET_QUERY_LOG_MAX_BYTES', 50 * 1024 * 1024)
+FACET_QUERY_LOG_BACKUP_COUNT = getattr(settings, 'FACET_QUERY_LOG_BACKUP_COUNT', 5)
+# Records waiting to be written, further records are dropped
+FACET_QUERY_LOG_BUFFER = getattr(settings, 'FACET_QUERY_LOG_BUFFER', 1000)
+# Most records written at once
+FACET_QUERY_LOG_BATCH = 100
+
+
+class JSONLFileSink(object):
+    '''
+    Writes records as JSON lines to a file, rotated when it reaches
+    max_bytes with backup_count old files kept.
+    '''
+    def __init__(self, path, max_bytes=FACET_QUERY_LOG_MAX_BYTES, backup_count=FACET_QUERY_LOG_BACKUP_COUNT):
+        self.handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+
+    def write(self, records):
+        for record in records:
+            self.handler.emit(logging.makeLogRecord({'msg': json.dumps(record, sort_keys=True)}))
+        self.handler.flush()
+
+
+class QueryLog(object):
+    '''
+    Records a sample of searches (filters, keywords, sort order, result
+    count, facet sizes and phase timings) to a sink. Records are buffered
+    and written by a background thread, so logging doesn't add to the
+    request time; if the buffer is full, records are dropped.
+
+        {"time": "2014-05-01T10:20:00.123456", "model": "trips_trip",
+         "filters": {"region": ["Asia"]}, "keywords": "", "order_by": "name",
+         "count": 120, "facets": {"region": 12, "country": 40}, "degraded": false,
+         "timings": {"prepare": 0.8, "facets": 21.5}}
+
+    Timings are in milliseconds. The count is the search's hit count,
+    also when the facets came from the facet cache or snapshot (they're
+    stored with it); it's the scaled estimate when the facets are
+    approximate, and None when they're degraded.
+    '''
+    def __init__(self, sink, sample_rate=FACET_QUERY_LOG_SAMPLE_RATE, buffer_size=FACET_QUERY_LOG_BUFFER):
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.queue = Queue.Queue(buffer_size)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def sample(self):
+        return random.random() < self.sample_rate
+
+    def record(self, search, timings):
+        model = search.searcher.model
+        record = {
+            'time': datetime.now().isoformat(),
+            'model': model and model._meta.db_table,
+            'filters': dict((field, sorted(value) if isinstance(value, (list, tuple)) else value)
+                            for field, value in search.cleaned_filters.iteritems()),
+            'keywords': search.keywords,
+            'order_by': search.order_by,
+            'count': search.hit_count,
+            'facets': dict((facet.field, len(facet.items)) for facet in search.facets),
+            'degraded': search.facets.degraded,
+            'timings': dict((phase, round(seconds * 1000, 2)) for phase, seconds in timings.iteritems()),
+        }
+        self._start()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            pass
+
+    def _start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._write, name='facet-query-log')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _write(self):
+        while True:
+            records = [self.queue.get()]
+            try:
+                while len(records) < FACET_QUERY_LOG_BATCH:
+                    records.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            try:
+                self.sink.write(records)
+            except Exception:
+                logger.exception('Could not write %d search records' % len(records))
+            for record in records:
+                self.queue.task_done()
+
+
+def get_default_query_log():
+    if FACET_QUERY_LOG_SINK:
+        return QueryLog(import_string(FACET_QUERY_LOG_SINK)(**FACET_QUERY_LOG_SINK_OPTIONS))
+    if FACET_QUERY_LOG:
+        return QueryLog(JSONLFileSink(FACET_QUERY_LOG))
+    return None
+
+default_query_log = get_default_query_log()
@@ -1,17 +1,34 @@
 import re
+import sys
+import copy
+import time
 import logging
+import threading
 from cgi import parse_qs
+from collections import OrderedDict
 from urllib import urlencode
 from datetime import datetime, timedelta
 
+from django.conf import settings
+from django.core.cache import cache
 from django.utils import datetime_safe
 from django.contrib.sites.models import Site
 
 from haystack.query import SearchQuerySet
 from haystack import connections
+from haystack.constants import ID, DJANGO_CT, DJANGO_ID
+from haystack.utils import get_model_ct
 
-from faceted_search.utils import DATETIME_REGEX, check_parse_date, humanize_range
-from faceted_search.facets import Facet, QueryFacet, FacetList, FacetItem
+from faceted_search.utils import (DATETIME_REGEX, check_parse_date, humanize_range, build_ranges, humanize_bounds,
+                                  run_parallel, round_date_range, date_range_days, cached_label)
+from faceted_search.facets import Facet, QueryFacet, HierarchicalFacet, FacetList, FacetItem
+from faceted_search.cache import make_cache_key, make_facet_key, facet_cache as default_facet_cache
+from faceted_search.prefetch import default_prefetcher
+from faceted_search.querylog import default_query_log
+from faceted_search.typeahead import get_value_index
+from faceted_search.fields import SAMPLE_BUCKETS
+from faceted_search.invalidation import default_invalidator, state_version_keys
+from faceted_search.snapshot import default_snapshot
 
 SORT_PARAM = 'order_by'
 KEYWORD_PARAM = 'q'
@@ -24,10 +41,175 @@ supplied with the search. This does not apply if sort order is explicitly set.
 '''
 USE_DEFAULT_SORT_WITH_KEYWORD = False
 
+# How long (seconds) histograms are cached for a filter state
+HISTOGRAM_CACHE_TIMEOUT = getattr(settings, 'FACET_HISTOGRAM_CACHE_TIMEOUT', 60 * 5)
+
+# Seconds a search waits for facet counts before degrading to cached facets
+# (see Searcher), None to always wait
+FACET_TIME_BUDGET = getattr(settings, 'FACET_TIME_BUDGET', None)
+# Most facet fetches allowed to overrun their budget at once. Beyond this,
+# searches degrade without sending a facet request.
+FACET_TIME_BUDGET_MAX_PENDING = getattr(settings, 'FACET_TIME_BUDGET_MAX_PENDING', 20)
+_facet_fetch_slots = threading.BoundedSemaphore(FACET_TIME_BUDGET_MAX_PENDING)
+
+# Hits above which facets are counted over a deterministic sample of the
+# results and scaled up (see Searcher), None to always count exactly
+FACET_APPROXIMATE_THRESHOLD = getattr(settings, 'FACET_APPROXIMATE_THRESHOLD', None)
+# Fraction of the results sampled, in steps of 1 / SAMPLE_BUCKETS
+FACET_SAMPLE_RATE = getattr(settings, 'FACET_SAMPLE_RATE', 0.1)
+# The index's SampleField
+FACET_SAMPLE_FIELD = getattr(settings, 'FACET_SAMPLE_FIELD', 'sample')
+
+# Most concurrent backend requests made by one search_many()
+SEARCH_MANY_WORKERS = getattr(settings, 'FACET_SEARCH_MANY_WORKERS', 4)
+# Typeahead candidates counted under the filters, as a multiple of the
+# number of values returned
+TYPEAHEAD_CANDIDATES = getattr(settings, 'FACET_TYPEAHEAD_CANDIDATES', 5)
+
+'''
+Facet config keys controlling how the facet's filters use the backend
+filter cache:
+    filter_cache    False for volatile filters (e.g. free-form ranges)
+                    that are rarely reused, so they don't evict others
+    filter_cost     with filter_cache False, the order uncached filters
+                    are applied in (cheapest first)
+    filter_round    'month' or 'year', to narrow date ranges on a cached
+                    filter widened to whole months/years plus an uncached
+                    exact one
+    filter_group    a name shared by low-selectivity facets that are
+                    usually selected together, whose filters are merged
+                    into one
+'''
+FILTER_OPTIONS = ('filter_cache', 'filter_cost', 'filter_round', 'filter_group')
+
 logger = logging.getLogger(__name__)
 
 class SearcherError(Exception): pass
 
+# (label, value) strftime formats of date facet items by gap
+DATE_GAP_FORMATS = {
+    '+1MONTH/MONTH': ('%B', '%Y-%m'),
+    '+1YEAR/YEAR': ('%Y', '%Y-01'),
+}
+
+@cached_label('date')
+def date_label(date, gap):
+    '''
+    The (label, value) of a date facet item
+    '''
+    label_format, value_format = DATE_GAP_FORMATS[gap]
+    return date.strftime(label_format), date.strftime(value_format)
+
+
+class StoredResult(object):
+    '''
+    A lightweight search result built only from the fields stored in the
+    index. Unlike haystack's SearchResult it has no `object`, so rendering
+    a list of these never loads the model.
+    '''
+    def __init__(self, app_label, model_name, pk, score, **kwargs):
+        self.app_label = app_label
+        self.model_name = model_name
+        self.pk = pk
+        self.score = score
+        self.__dict__.update(kwargs)
+
+    def __repr__(self):
+        return '<StoredResult: %s.%s (pk=%r)>' % (self.app_label, self.model_name, self.pk)
+
+
+class Search(object):
+    '''
+    The filters, results and facets of one Searcher.search(). Iterating,
+    slicing and counting a Search works on its results (a SearchQuerySet).
+    '''
+    def __init__(self, searcher, filters=None, keywords=None, order_by='', search_kwargs=None):
+        self.searcher = searcher
+        self.filters = filters or {}
+        self.search_kwargs = search_kwargs or {}
+        self.cleaned_filters = searcher._clean_filters(self.filters)
+        self.use_default_order = not order_by
+        self.order_by = searcher.clean_sort_order(order_by)
+        self.keywords = keywords or self.filters.get(KEYWORD_PARAM, '')
+        if isinstance(self.keywords, (list, tuple)):
+            self.keywords = ' '.join(self.keywords)
+        if self.keywords and not USE_DEFAULT_SORT_WITH_KEYWORD and self.use_default_order:
+            self.order_by = ''
+        self.queryset = None
+        self.selected_values = {}
+        self.facets = FacetList()
+        self.hit_count = None
+        self.facets_thread = None
+        self.facets_error = None
+
+    def __iter__(self):
+        return iter(self.queryset)
+
+    def __len__(self):
+        return len(self.queryset)
+
+    def __getitem__(self, k):
+        return self.queryset[k]
+
+    def count(self):
+        return self.queryset.count()
+
+    def wait_facets(self):
+        '''
+        Waits for facets counted in the background (see the defer_facets
+        argument of Searcher.search) and returns them. Errors counting them
+        are raised here.
+        '''
+        if self.facets_thread is not None:
+            self.facets_thread.join()
+        if self.facets_error is not None:
+            exc_type, exc_value, traceback = self.facets_error
+            raise exc_type, exc_value, traceback
+        return self.facets
+
+    def url_param(self):
+        '''
+        Construct the URL parameters of the search. This is a combination
+        of facet parameters, keywords, and sorting. This does not include
+        the question mark, only the '&' joined key-values.
+        '''
+        return self.facets.url_param()
+
+    @property
+    def sort_options(self):
+        '''
+        A list of sort option dicts
+        (
+            {'url':'...', 'label': 'A name', 'selected':True}
+        )
+        '''
+        opts = []
+        use_default = not self.order_by
+
+        # Remove any existing sort order parameters that may have been
+        # included as extra_params to the FacetList. This prevents multiple
+        # sort orders from being included in the sort urls.
+        query = parse_qs(self.facets.url_param())
+        query.pop(SORT_PARAM, None) 
+
+        for conf in self.searcher.sort_config:
+            reverse = conf.get('reverse', False)
+            field = conf.get('field') if not reverse else '-%s'% conf.get('field')
+            is_default = conf.get('default', False)
+            if not is_default:
+                sort_query = {SORT_PARAM: field}
+                sort_query.update(query)
+                url = '?%s' % urlencode(sort_query, doseq=True)
+            else:
+                url = '?%s' % urlencode(query, doseq=True)
+
+            opts.append({
+                'url': url,
+                'label': conf.get('label'),
+                'selected': (use_default and is_default) or (self.order_by == field),
+            })
+        return opts
+
 
 class Searcher(object):
     '''
@@ -37,17 +219,103 @@ class Searcher(object):
         * find a different way to configure facet behaviour, perhaps directly in the index class??? e.g. meta?
     '''     
 
-    def __init__(self, model=None, facets={}, sort_config={}):
+    def __init__(self, model=None, facets={}, sort_config={}, stored_fields=None,
+                 facet_cache=default_facet_cache, prefetcher=default_prefetcher,
+                 query_log=default_query_log, facet_time_budget=FACET_TIME_BUDGET,
+                 approximate_threshold=FACET_APPROXIMATE_THRESHOLD, sample_rate=FACET_SAMPLE_RATE,
+                 invalidator=default_invalidator, snapshot=default_snapshot):
+        '''
+        stored_fields
+            optional list of stored index fields. When given, only these
+            fields are returned and results are StoredResults rather than
+            haystack SearchResults, so no model hydration takes place.
+        facet_cache
+            a FacetCache for sharing parsed facets between processes,
+            by default the one configured by settings.FACET_CACHE_ALIAS
+        prefetcher
+            a FacetPrefetcher which fetches the facets of likely next
+            states into the facet cache after each search, by default
+            the one enabled by settings.FACET_PREFETCH
+        query_log
+            a QueryLog which records a sample of searches, by default the
+            one configured by settings.FACET_QUERY_LOG(_SINK)
+        facet_time_budget
+            seconds to wait for facet counts. If they take longer, the
+            search returns the last cached facets for the state, or those of
+            the nearest cached parent state (one filter value fewer), or no
+            facets, with facets.degraded set. The counts are still cached
+            when they arrive.
+        approximate_threshold
+            hit count above which facets are counted over a sample_rate
+            sample of the results (the index's SampleField, see
+            settings.FACET_SAMPLE_FIELD) and scaled up, with
+            facets.approximate set. Items only in the unsampled results
+            are missing. The sample is counted first, so searches below
+            the threshold make two facet requests (sampled, then exact),
+            and above it the search's hit_count (cached with the facets)
+            is the scaled estimate too. None to always count exactly.
+        invalidator
+            a FacetCacheInvalidator whose versions of filter states are
+            stored with cached facets, so that indexing a document only
+            invalidates the states it affects; by default the one enabled
+            by settings.FACET_CACHE_INVALIDATION
+        snapshot
+            a FacetSnapshot of precomputed facets for hot states, read
+            before the facet cache, by default the one at
+            settings.FACET_SNAPSHOT. Its facets are as of its last rebuild,
+            but with an invalidator they're only used while their state's
+            version is unchanged (at the cost of reading the version).
+        '''
         self.model = model
-        self.queryset = None
+        self.stored_fields = stored_fields
+        self.facet_cache = facet_cache
+        self.prefetcher = prefetcher
+        self.query_log = query_log
+        self.facet_time_budget = facet_time_budget
+        self.approximate_threshold = approximate_threshold
+        self.sample_rate = sample_rate
+        self.invalidator = invalidator if facet_cache is not None else None
+        self.snapshot = snapshot
+        self.facet_config = facets
         self.field_facets = facets.get('fields', {})
         self.date_facets = facets.get('dates', {})
         self.query_facets = facets.get('queries', {})
-        self.facets = FacetList()
+        self.range_facets = facets.get('ranges', {})
+        self.pivot_facets = facets.get('pivots', {})
         self.indexed_fields = connections['default'].get_unified_index().all_searchfields()
         self.sort_config = sort_config
 
-    def search(self, filters=None, keywords=None, order_by='', **kwargs):
+        # Lookup tables so that per-request work doesn't scan the config
+        self.sort_configs = {}
+        self._default_sort_order = None
+        for conf in reversed(list(sort_config)):
+            reverse = conf.get('reverse', False)
+            self.sort_configs[(conf['field'], reverse)] = conf
+            if conf.get('default', False):
+                self._default_sort_order = conf['field'] if not reverse else '-%s' % conf['field']
+        self.facet_labels = dict((field, field.replace('_', ' ').title()) for field in self.query_facets)
+        for configs in (self.field_facets, self.range_facets, self.date_facets, self.pivot_facets):
+            for field, conf in configs.iteritems():
+                self.facet_labels[field] = conf.get('label', field.replace('_', ' ').title())
+        # Date facets counted and narrowed on a CompactDateField
+        self.date_range_fields = dict((field, conf['range_field']) for field, conf in self.date_facets.iteritems()
+                                      if conf.get('range_field'))
+        self.filter_options = {}
+        for configs in (self.field_facets, self.range_facets, self.date_facets, self.pivot_facets):
+            for field, conf in configs.iteritems():
+                options = dict((k, v) for k, v in conf.iteritems() if k in FILTER_OPTIONS)
+                if options:
+                    self.filter_options[field] = options
+        self.multiselect_fields = set(f for f, conf in self.field_facets.iteritems() if conf.get('multiselect', False))
+        for field, conf in self.pivot_facets.iteritems():
+            if conf.get('multiselect', False):
+                self.multiselect_fields.update((field, conf['child']))
+        # Fields filtered by indexed values rather than ranges
+        self.exact_fields = set(self.field_facets) | set(self.pivot_facets)
+        self.exact_fields.update(conf['child'] for conf in self.pivot_facets.values())
+        self.faceted_fields = set(f for f, field in self.indexed_fields.iteritems() if field.faceted)
+
+    def search(self, filters=None, keywords=None, order_by='', defer_facets=False, **kwargs):
         '''
         filters
             the field-value which all results must match
@@ -55,33 +323,150 @@ class Searcher(object):
             plain search string for matching text
         order_by
             the sort order of the results (a field name)
+        defer_facets
+            count the facets in a background thread, so that the results
+            can be used (e.g. rendered) meanwhile; Search.wait_facets()
+            returns them when they're ready. Until then the Search's
+            facets are empty and its hit_count is None.
+
+        Returns a Search holding the results and facets. The Searcher
+        itself isn't modified, so one can be shared between threads.
         '''
         logger.debug("Searching with filters %s" % filters)
-        self.filters = filters or {}
-        self.cleaned_filters = self._clean_filters(self.filters)
-        self.queryset = SearchQuerySet()
-        self.use_default_order = not order_by
-        self.order_by = self.clean_sort_order(order_by)
-        self.keywords = keywords or self.filters.get(KEYWORD_PARAM, '')
-        if self.keywords and not USE_DEFAULT_SORT_WITH_KEYWORD and self.use_default_order:
-            self.order_by = ''
-        self.queryset = self.queryset.models(self.model).filter(**kwargs)
-        self._narrow_queryset(self.cleaned_filters)
-        self._keyword_filtered()
-        self._field_faceted()
-        self._query_faceted()
-        self._date_faceted()
-        self._ordered()
-        self.facets = self._facets()
-        self.search_performed = True
-        return self.queryset
- 
+        started = time.time()
+        search = self._prepare(filters, keywords, order_by, **kwargs)
+        if not defer_facets:
+            self._finish_search(search, started)
+            return search
+
+        # The facets are counted on a copy with its own queryset, as
+        # querysets aren't safe to use from two threads
+        facet_search = copy.copy(search)
+        facet_search.queryset = search.queryset._clone()
+        def finish():
+            try:
+                self._finish_search(facet_search, started)
+            except Exception:
+                search.facets_error = sys.exc_info()
+            search.facets, search.hit_count = facet_search.facets, facet_search.hit_count
+        search.facets_thread = threading.Thread(target=finish, name='facet-search')
+        search.facets_thread.daemon = True
+        search.facets_thread.start()
+        return search
+
+    def _finish_search(self, search, started):
+        prepared = time.time()
+        search.facets = self._facets(search)
+        if self.query_log is not None and self.query_log.sample():
+            self.query_log.record(search, {'prepare': prepared - started, 'facets': time.time() - prepared})
+        if self.prefetcher is not None:
+            self.prefetcher.schedule(self, search)
+
+    def prefetch_facets(self, filters=None, keywords=None, **kwargs):
+        '''
+        Like search() but only fetches the facets (no results), so that
+        they are in the facet cache for a later search of the same state.
+        '''
+        return self._facets_only(filters, keywords, **kwargs).facets
+
+    def search_many(self, filter_sets, keywords=None, facets=True, workers=SEARCH_MANY_WORKERS, **kwargs):
+        '''
+        The hit count and facets of many filter states at once, e.g. for a
+        page showing the number of trips in each region. Returns a Search
+        (without results) per filter set. A filter set's own keywords (its
+        'q') override keywords. States in the facet cache aren't fetched
+        again.
+
+        With facets=False only the hit counts are needed, so the uncached
+        states are counted in one backend request with a query facet per
+        state (one request per state if the backend has no raw query
+        facets, see faceted_search.backends); states with different
+        keywords are counted in separate requests. Otherwise they're
+        fetched in parallel on up to `workers` threads.
+        '''
+        def own_keywords(filters):
+            return (filters or {}).get(KEYWORD_PARAM) or keywords
+
+        if facets:
+            return run_parallel(lambda filters: self._facets_only(filters, own_keywords(filters), **kwargs),
+                                filter_sets, workers)
+
+        searches = [Search(self, filters, own_keywords(filters), search_kwargs=kwargs) for filters in filter_sets]
+        uncounted = searches
+        if self.facet_cache is not None:
+            keys = [self.facet_cache_key(search) for search in searches]
+            versions = [self.facet_state_version(search) for search in searches] if self.invalidator else None
+            cached = self.facet_cache.get_many(keys, versions)
+            for search, key in zip(searches, keys):
+                if key in cached:
+                    search.hit_count = cached[key][0]
+            uncounted = [search for search in searches if search.hit_count is None]
+
+        by_keywords = OrderedDict()
+        for search in uncounted:
+            by_keywords.setdefault(search.keywords, []).append(search)
+        run_parallel(lambda group: self._count(group[1], group[0], **kwargs), by_keywords.items(), workers)
+        return searches
+
+    def _count(self, searches, keywords=None, **kwargs):
+        '''
+        Sets the hit counts of searches with the same keywords, with a raw
+        query facet of each search's narrows where the backend supports
+        them, otherwise with a request per search.
+        '''
+        queryset = SearchQuerySet().models(self.model).filter(**kwargs)
+        if keywords:
+            queryset = queryset.filter(text=queryset.query.clean(keywords))
+
+        narrows = []
+        for search in searches:
+            search_narrows, search.selected_values = self._narrows(search.cleaned_filters, tag=False)
+            narrows.append(search_narrows)
+
+        if not hasattr(queryset.query, 'add_raw_query_facet'):
+            for search, search_narrows in zip(searches, narrows):
+                narrowed = queryset
+                for narrow in search_narrows:
+                    narrowed = narrowed.narrow(narrow)
+                search.hit_count = narrowed.count()
+            return
+
+        queryset = queryset._clone()
+        facet_queries = []
+        for search_narrows in narrows:
+            facet_query = ' AND '.join('(%s)' % narrow for narrow in search_narrows) or None
+            if facet_query:
+                queryset.query.add_raw_query_facet(facet_query)
+            facet_queries.append(facet_query)
+        query = queryset.query
+        query.set_limits(0, 0)
+        query_counts = query.get_facet_counts().get('queries', {})
+        for search, facet_query in zip(searches, facet_queries):
+            search.hit_count = query_counts.get(facet_query, 0) if facet_query else query.get_count()
+
+    def _facets_only(self, filters=None, keywords=None, **kwargs):
+        search = self._prepare(filters, keywords, **kwargs)
+        search.queryset.query.set_limits(0, 0)
+        search.facets = self._facets(search)
+        return search
+
+    def _prepare(self, filters=None, keywords=None, order_by='', **kwargs):
+        search = Search(self, filters, keywords, order_by, kwargs)
+        search.queryset = SearchQuerySet().models(self.model).filter(**kwargs)
+        self._narrow_queryset(search, search.cleaned_filters)
+        self._keyword_filtered(search)
+        self._field_faceted(search)
+        self._pivot_faceted(search)
+        self._query_faceted(search)
+        self._range_faceted(search)
+        self._date_faceted(search)
+        self._ordered(search)
+        self._stored(search)
+        return search
+
     @property
     def default_sort_order(self):
-        for conf in self.sort_config:
-            if conf.get('default', False):
-                return conf.get('field') if not conf.get('reverse', False) else '-%s'% conf.get('field')
-        return None
+        return self._default_sort_order
 
     def clean_sort_order(self, sort_order):
         '''
@@ -101,22 +486,102 @@ class Searcher(object):
             return {}
         is_reverse = sort_order.startswith('-')
         field = sort_order[1:] if is_reverse else sort_order
-        for conf in self.sort_config:
-            if conf['field'] == field and conf.get('reverse', False) == is_reverse:
-                return conf
+        conf = self.sort_configs.get((field, is_reverse))
+        if conf:
+            return conf
         logger.warning('No sort_order config found for %s' % sort_order)
         return {}
 
-    def url_param(self):
+    def histogram(self, field, start, end, gap, filters=None):
         '''
-        Construct the URL parameters from the last search performed. This
-        is a combination of facet parameters, keywords, and sorting. This
-        does not include the question mark, only the '&' joined key-values.
+        Min/max stats and a histogram (gap sized buckets from start to end,
+        plus everything above end) of a numeric field under the given
+        filters. Any filter on the field itself is ignored so the whole
+        distribution is returned, e.g. for drawing a price slider.
+
+        Fetched with one facets-only backend request and cached per
+        filter state:
+            {'field': 'min_price_USD', 'min': 450.0, 'max': 7200.0, 'count': 320,
+             'histogram': [(0, 50, 0), ..., (5000, None, 12)]}
         '''
-        if not self.search_performed:
-            raise SearcherError('No search has been performed')
+        filters = filters or {}
+        keywords = filters.get(KEYWORD_PARAM, '')
+        if isinstance(keywords, (list, tuple)):
+            keywords = ' '.join(keywords)
+        cleaned_filters = self._clean_filters(filters)
+        cleaned_filters.pop(field, None)
 
-        return self.facets.url_param()
+        key = make_cache_key('histogram', self.model and self.model._meta.db_table,
+                             field, start, end, gap, keywords, cleaned_filters)
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+        config = {'start': start, 'end': end, 'gap': gap, 'after': True}
+        queryset, selected_values = self._narrowed(SearchQuerySet().models(self.model), cleaned_filters)
+        if keywords:
+            queryset = queryset.filter(text=queryset.query.clean(keywords))
+        queryset = self._range_facet(queryset.stats(field), field, config)
+
+        # Only facets and stats are needed, so don't fetch any results
+        query = queryset.query
+        query.set_limits(0, 0)
+        facet_counts = query.get_facet_counts()
+        stats = (query.get_stats() or {}).get(field) or {}
+        counts = self._range_counts(field, config, facet_counts.get('ranges', {}), facet_counts.get('queries', {})) or []
+
+        result = {
+            'field': field,
+            'min': stats.get('min'),
+            'max': stats.get('max'),
+            'count': stats.get('count', 0),
+            'histogram': [(lower, upper, count) for (lower, upper, query), count in counts],
+        }
+        cache.set(key, result, HISTOGRAM_CACHE_TIMEOUT)
+        return result
+
+    def facet_values(self, field, prefix, filters=None, limit=10):
+        '''
+        The values of a facet field starting with prefix (case and accent
+        insensitive) with their counts under the given filters, e.g. for a
+        typeahead over a facet with too many values to list:
+            [(u'Zambia', 31), (u'Zanzibar', 12)]
+
+        Candidates come from the process' prefix index of the field's
+        values (see faceted_search.typeahead); up to TYPEAHEAD_CANDIDATES
+        times limit of them are counted with one facets-only request. Any
+        filter on the field itself is ignored.
+        '''
+        candidates = get_value_index(self.model, field).match(prefix, limit * TYPEAHEAD_CANDIDATES)
+        if not candidates:
+            return []
+
+        filters = filters or {}
+        keywords = filters.get(KEYWORD_PARAM, '')
+        if isinstance(keywords, (list, tuple)):
+            keywords = ' '.join(keywords)
+        cleaned_filters = self._clean_filters(filters)
+        cleaned_filters.pop(field, None)
+
+        queryset, selected_values = self._narrowed(SearchQuerySet().models(self.model), cleaned_filters)
+        if keywords:
+            queryset = queryset.filter(text=queryset.query.clean(keywords))
+        escaped = []
+        for value, count in candidates:
+            escaped.append(self._solr_escape_value(unicode(value)))
+            queryset = queryset.query_facet(field, escaped[-1])
+
+        query = queryset.query
+        query.set_limits(0, 0)
+        query_counts = query.get_facet_counts().get('queries', {})
+        facet_field = connections['default'].get_unified_index().get_facet_fieldname(field)
+        values = []
+        for (value, unfiltered_count), escaped_value in zip(candidates, escaped):
+            count = query_counts.get('%s:%s' % (facet_field, escaped_value), 0)
+            if count:
+                values.append((value, count))
+        values.sort(key=lambda value_count: -value_count[1])
+        return values[:limit]
 
     def _clean_filters(self, filters):
         '''
@@ -124,96 +589,270 @@ class Searcher(object):
         '''
         cleaned = {}
         for key, value in filters.items():
+            if isinstance(value, (list, tuple)):
+                value = [v for v in value if v]
             if key in self.indexed_fields and value:
                 cleaned[key] = value
 
         return cleaned
 
-    def _facets(self):
+    def _facets(self, search):
         '''
-        Fetch and parse facet counts.
+        Fetch and parse facet counts, or rebuild them from the facet
+        snapshot or cache if they have been parsed for this state before.
         '''
-        facet_counts = self.queryset.facet_counts()
-        facets = self._parse_field_facets(facet_counts.get('fields', {}))
-        facets = facets + self._parse_query_facets(facet_counts.get('queries', {}))
-        facets = facets + self._parse_date_facets(facet_counts.get('dates', {}))
-        
         extra_params = {}
-        if self.keywords:
-            extra_params[KEYWORD_PARAM] = self.keywords
-        if self.order_by and not self.use_default_order:
-            extra_params[SORT_PARAM] = self.order_by
+        if search.keywords:
+            extra_params[KEYWORD_PARAM] = search.keywords
+        if search.order_by and not search.use_default_order:
+            extra_params[SORT_PARAM] = search.order_by
+
+        cache_key = None
+        # Read before the counts are fetched, so an update meanwhile
+        # invalidates them
+        version = self.facet_state_version(search)
+        if self.snapshot is not None:
+            payload = self.snapshot.get(self.facet_cache_key(search))
+            if payload is not None and payload[3] == version:
+                search.hit_count, facet_data, approximate = payload[:3]
+                return FacetList.decode(facet_data, extra_params=extra_params, approximate=approximate)
+        if self.facet_cache is not None:
+            cache_key = self.facet_cache_key(search)
+            payload = self.facet_cache.get(cache_key, version)
+            if payload is not None:
+                search.hit_count, facet_data = payload[:2]
+                approximate = len(payload) > 2 and payload[2]
+                return FacetList.decode(facet_data, extra_params=extra_params, approximate=approximate)
+
+        if self.facet_time_budget is None:
+            return self._fetch_facets(search, extra_params, cache_key, version)
+
+        fetched = {}
+        def fetch():
+            try:
+                fetched['facets'] = self._fetch_facets(search, extra_params, cache_key, version)
+            except Exception:
+                logger.exception('Could not fetch facets')
+            finally:
+                _facet_fetch_slots.release()
+
+        if _facet_fetch_slots.acquire(False):
+            thread = threading.Thread(target=fetch, name='facet-fetch')
+            thread.daemon = True
+            thread.start()
+            thread.join(self.facet_time_budget)
+        if 'facets' in fetched:
+            return fetched['facets']
+        logger.warning('Facets took longer than %ss, degrading' % self.facet_time_budget)
+        return self._degraded_facets(search, extra_params, cache_key)
 
-        facet_list = FacetList(extra_params=extra_params)
+    def _fetch_facets(self, search, extra_params, cache_key=None, version=None):
+        # Run on a clone like SearchQuerySet.facet_counts(), keeping the hit count
+        query = search.queryset.query._clone()
+        scale = None
+        if self.approximate_threshold is not None:
+            # Count over a sample first; only if the estimated hits are
+            # below the threshold are the exact counts fetched
+            buckets = max(1, min(SAMPLE_BUCKETS, int(round(self.sample_rate * SAMPLE_BUCKETS))))
+            sampled = query._clone()
+            sampled.add_narrow_query('%s:[0 TO %d]' % (FACET_SAMPLE_FIELD, buckets - 1))
+            facet_counts = sampled.get_facet_counts()
+            scale = float(SAMPLE_BUCKETS) / buckets
+            search.hit_count = int(round(sampled.get_count() * scale))
+            if search.hit_count < self.approximate_threshold:
+                scale = None
+        if scale is None:
+            facet_counts = query.get_facet_counts()
+            search.hit_count = query.get_count()
+        facets = self._parse_field_facets(search, facet_counts.get('fields', {}))
+        facets = facets + self._parse_query_facets(search, facet_counts.get('queries', {}))
+        facets = facets + self._parse_range_facets(search, facet_counts.get('ranges', {}), facet_counts.get('queries', {}))
+        date_counts = dict(facet_counts.get('dates', {}))
+        date_counts.update(self._date_range_counts(facet_counts.get('ranges', {})))
+        facets = facets + self._parse_date_facets(search, date_counts)
+        facets = facets + self._parse_pivot_facets(search, facet_counts.get('pivots', {}), facet_counts.get('fields', {}))
+
+        facet_list = FacetList(extra_params=extra_params, approximate=scale is not None)
         for facet in facets:
             facet_list.append(facet)
+        if scale is not None:
+            for facet in facet_list:
+                for item in facet.items + [c for i in facet.items for c in i.children]:
+                    item.count = int(round(item.count * scale))
+
+        if cache_key is not None:
+            self.facet_cache.set(cache_key, (search.hit_count, facet_list.encode(), facet_list.approximate), version)
         return facet_list
 
-    @property
-    def sort_options(self):
+    def _degraded_facets(self, search, extra_params, cache_key=None):
         '''
-        A list of sort option dicts
-        (
-            {'url':'...', 'label': 'A name', 'selected':True}
-        )
+        Facets for a search whose facet counts didn't arrive in time: the
+        last facets cached for this state, or those of the nearest cached
+        parent state with the items of this search selected, or none.
         '''
-        opts = []
-        use_default = not self.order_by
+        payload = None
+        if cache_key is not None:
+            payload = self.facet_cache.get_stale(cache_key)
+            if payload is None:
+                parent_keys = [self.facet_cache_key(search, f) for f in self._parent_filters(search.cleaned_filters)]
+                cached = self.facet_cache.get_many(parent_keys)
+                payload = next((cached[key] for key in parent_keys if key in cached), None)
 
-        # Remove any existing sort order parameters that may have been
-        # included as extra_params to the FacetList. This prevents multiple
-        # sort orders from being included in the sort urls.
-        query = parse_qs(self.facets.url_param())
-        query.pop(SORT_PARAM, None) 
-        query = dict((k, v[0]) for k, v in query.iteritems())
+        if payload is None:
+            return FacetList(extra_params=extra_params, degraded=True)
 
-        for conf in self.sort_config:
-            reverse = conf.get('reverse', False)
-            field = conf.get('field') if not reverse else '-%s'% conf.get('field')
-            is_default = conf.get('default', False)
-            if not is_default:
-                sort_query = {SORT_PARAM: field}
-                sort_query.update(query)
-                url = '?%s' % urlencode(sort_query)
+        facet_list = FacetList.decode(payload[1], extra_params=extra_params, degraded=True)
+        for facet in facet_list:
+            for item in facet.items + [c for i in facet.items for c in i.children]:
+                item.is_selected = self._is_selected_facet(search, item.facet.field, check_parse_date(unicode(item.value)))
+        return facet_list
+
+    def _parent_filters(self, filters):
+        '''
+        The filters with one value fewer, nearest first
+        '''
+        parents = []
+        for field in sorted(filters):
+            value = filters[field]
+            if isinstance(value, (list, tuple)) and len(value) > 1:
+                for v in value:
+                    parents.append(dict(filters, **{field: [o for o in value if o != v]}))
             else:
-                url = '?%s' % urlencode(query)
+                parents.append(dict((f, v) for f, v in filters.iteritems() if f != field))
+        return parents
 
-            opts.append({
-                'url': url,
-                'label': conf.get('label'),
-                'selected': (use_default and is_default) or (self.order_by == field),
-            })
-        return opts
+    def facet_cache_key(self, search, cleaned_filters=None):
+        '''
+        The facet cache key of a search, or of the given filters with the
+        same keywords. Facets depend on the filters, keywords and extra
+        search kwargs but not the sort order.
+        '''
+        if cleaned_filters is None:
+            cleaned_filters = search.cleaned_filters
+        facet_fields = (sorted(self.field_facets), sorted(self.query_facets),
+                        sorted(self.range_facets), sorted(self.date_facets), sorted(self.pivot_facets))
+        return make_facet_key(self.model and self.model._meta.db_table, facet_fields,
+                              cleaned_filters, search.keywords, search.search_kwargs)
 
-    def _ordered(self):
-        if not self.order_by:
+    def facet_state_version(self, search):
+        '''
+        The invalidator's current version of the search's filter state,
+        None without an invalidator
+        '''
+        if self.invalidator is None:
+            return None
+        model_ct = self.model and get_model_ct(self.model)
+        return self.invalidator.version(state_version_keys(model_ct, search.cleaned_filters, search.keywords,
+                                                           self.exact_fields, self.faceted_fields,
+                                                           self.multiselect_fields))
+
+    def _ordered(self, search):
+        if not search.order_by:
             return
-        self.queryset = self.queryset.order_by(self.order_by)
+        search.queryset = search.queryset.order_by(search.order_by)
                                            
-    def _keyword_filtered(self):
-        if self.keywords:
-            self.queryset = self.queryset.filter(text=self.queryset.query.clean(self.keywords))
+    def _stored(self, search):
+        if not self.stored_fields:
+            return
+        search.queryset = search.queryset.result_class(StoredResult)
+        # The id, type and score are always needed to build a result
+        search.queryset.query.fields = [ID, DJANGO_CT, DJANGO_ID, 'score'] + list(self.stored_fields)
+
+    def _keyword_filtered(self, search):
+        if search.keywords:
+            search.queryset = search.queryset.filter(text=search.queryset.query.clean(search.keywords))
 
-    def _field_faceted(self):
+    def _field_faceted(self, search):
         '''
         See search_indexes.py for the defined faceted fields.
+
+        Multi-select facets exclude their own (tagged) filter so that
+        sibling counts are still returned when a value is selected.
         '''
         for field, config in self.field_facets.iteritems():
-            self.queryset = self.queryset.facet(field)
+            if field in self.multiselect_fields and field in search.cleaned_filters:
+                facet_field = connections['default'].get_unified_index().get_facet_fieldname(field)
+                search.queryset = search.queryset.facet('{!ex=%s}%s' % (field, facet_field))
+            else:
+                search.queryset = search.queryset.facet(field)
+
+    def _pivot_faceted(self, search):
+        '''
+        Hierarchical facets are counted with one pivot facet (child values
+        nested within parent values) where the backend supports it (see
+        faceted_search.backends), otherwise only the parent is faceted.
+        '''
+        for field, config in self.pivot_facets.iteritems():
+            fields = (field, config['child'])
+            if hasattr(search.queryset.query, 'add_pivot_facet'):
+                exclude_tags = [f for f in fields if f in self.multiselect_fields and f in search.cleaned_filters]
+                search.queryset = search.queryset._clone()
+                search.queryset.query.add_pivot_facet(fields, exclude_tags)
+            else:
+                search.queryset = search.queryset.facet(field)
 
-    def _query_faceted(self):
+    def _query_faceted(self, search):
         for field, queries in self.query_facets.iteritems():
             for query in queries:
-                self.queryset = self.queryset.query_facet(field, query)
+                search.queryset = search.queryset.query_facet(field, query)
+
+    def _range_faceted(self, search):
+        '''
+        Range facets are sent as one native range facet per field where the
+        backend supports it (see faceted_search.backends), otherwise as the
+        equivalent query facets.
+        '''
+        for field, config in self.range_facets.iteritems():
+            search.queryset = self._range_facet(search.queryset, field, config)
+
+    def _range_facet(self, queryset, field, config):
+        if hasattr(queryset.query, 'add_range_facet'):
+            queryset = queryset._clone()
+            queryset.query.add_range_facet(field, **config)
+        else:
+            for lower, upper, query in build_ranges(**config):
+                queryset = queryset.query_facet(field, query)
+        return queryset
 
-    def _date_faceted(self):
+    def _date_faceted(self, search):
+        '''
+        Date facets with a 'range_field' (a CompactDateField) are counted
+        with a range facet on that field where the backend supports it.
+        '''
         for field, config in self.date_facets.iteritems():
-            self.queryset = self.queryset.date_facet(field, 
+            if field in self.date_range_fields and hasattr(search.queryset.query, 'add_range_facet'):
+                search.queryset = self._range_facet(search.queryset, self.date_range_fields[field], {
+                    'start': config['start_date'],
+                    'end': config['end_date'],
+                    'gap': self._date_gap(config),
+                })
+                continue
+            search.queryset = search.queryset.date_facet(field, 
                         start_date=config['start_date'],
                         end_date=config['end_date'],
                         gap_by=config['gap_by'])
 
-    def _parse_date_facets(self, facet_items):
+    def _date_gap(self, config):
+        '''
+        The date math gap of a date facet, as sent by haystack, e.g. '+1MONTH/MONTH'
+        '''
+        gap_by = config['gap_by'].upper()
+        gap_amount = config.get('gap_amount', 1)
+        return '+%d%s%s/%s' % (gap_amount, gap_by, 'S' if gap_amount != 1 else '', gap_by)
+
+    def _date_range_counts(self, facet_items):
+        '''
+        Converts range facet counts of CompactDateFields back to the date
+        facet counts of the facets they stand in for.
+        '''
+        counts = {}
+        for field, range_field in self.date_range_fields.iteritems():
+            if range_field in facet_items:
+                counts[field] = dict(facet_items[range_field].get('counts', []))
+                counts[field]['gap'] = self._date_gap(self.date_facets[field])
+        return counts
+
+    def _parse_date_facets(self, search, facet_items):
         '''
         Parse date faceted fields like:
             {'departure_dates': {'2010-04-24T18:17:03Z': 105,
@@ -234,7 +873,7 @@ class Searcher(object):
         '''
         facets = []
         for field, date_counts in facet_items.iteritems():
-            facet = Facet(field=field, label=field.replace('_', ' ').title())
+            facet = Facet(field=field, label=self._facet_label(field))
             gap = date_counts['gap']
             for date_string, count in date_counts.iteritems():
                 match = DATETIME_REGEX.search(date_string)
@@ -242,20 +881,16 @@ class Searcher(object):
                 data = match.groupdict()
                 date = datetime_safe.date(int(data['year']), int(data['month']), int(data['day']))
                 item = FacetItem(date, count)
-                if gap == '+1MONTH/MONTH':
-                    item.label=date.strftime("%B")
-                    item.value=date.strftime("%Y-%m")
-                elif gap == '+1YEAR/YEAR':
-                    item.label=date.strftime("%Y")
-                    item.value=date.strftime("%Y-01") 
-                item.is_selected = self._is_selected_facet(field, check_parse_date(item.value))
+                if gap in DATE_GAP_FORMATS:
+                    item.label, item.value = date_label(date, gap)
+                item.is_selected = self._is_selected_facet(search, field, check_parse_date(item.value))
                 item.facet = facet
                 facet.items.append(item)
             facet.items.sort(key=lambda x: x.value)
             facets.append(facet)
         return facets
 
-    def _parse_query_facets(self, facet_items):
+    def _parse_query_facets(self, search, facet_items):
         '''
         Parses query facet counts like this:
             {
@@ -277,18 +912,69 @@ class Searcher(object):
         for field_query, count in facet_items.iteritems():
             field, sep, query = field_query.partition(':')
             field = field.replace('_exact', '')
+            if field in self.range_facets:
+                continue
             if field in facets:
                 facet = facets[field]
             else:
-                facet = QueryFacet(field=field, label=field.replace('_', ' ').title())
+                facet = QueryFacet(field=field, label=self._facet_label(field))
                 facets[field] = facet       
             item = FacetItem(query, count, label=humanize_range(query))
-            item.is_selected = self._is_selected_facet(field, item.value)
+            item.is_selected = self._is_selected_facet(search, field, item.value)
             item.facet = facet
             facet.items.append(item)
         return [facet for field,facet in facets.iteritems()]    
 
-    def _parse_field_facets(self, facet_items):
+    def _parse_range_facets(self, search, facet_items, query_items=None):
+        '''
+        Parses native range facet counts like this:
+            {'duration': {'counts': [('5', 329), ('10', 256), ('15', 149)],
+                          'start': 5, 'end': 20, 'gap': 5,
+                          'before': 205, 'after': 87}}
+
+        The bucket bounds come from the range config, in the same order
+        the counts are returned. Backends without range faceting return the
+        equivalent query facets, which are looked up in query_items.
+        '''
+        facets = []
+        for field, conf in self.range_facets.iteritems():
+            counts = self._range_counts(field, conf, facet_items, query_items)
+            if counts is None:
+                continue
+
+            facet = QueryFacet(field=field, label=self._facet_label(field))
+            for (lower, upper, query), count in counts:
+                item = FacetItem(query, count, label=humanize_bounds(lower, upper))
+                item.start, item.end = lower, upper
+                item.is_selected = self._is_selected_facet(search, field, item.value)
+                item.facet = facet
+                facet.items.append(item)
+            facets.append(facet)
+        return facets
+
+    def _range_counts(self, field, conf, facet_items, query_items=None):
+        '''
+        Pairs each (lower, upper, query) bucket of a range config with its
+        count, or returns None if the field wasn't faceted.
+        '''
+        query_items = query_items or {}
+        ranges = build_ranges(**conf)
+        if field in facet_items:
+            details = facet_items[field]
+            counts = [count for value, count in details.get('counts', [])]
+            if conf.get('before', False):
+                counts.insert(0, details.get('before', 0))
+            if conf.get('after', False):
+                counts.append(details.get('after', 0))
+        else:
+            facet_field = connections['default'].get_unified_index().get_facet_fieldname(field)
+            queries = ['%s:%s' % (facet_field, query) for lower, upper, query in ranges]
+            if not any(q in query_items for q in queries):
+                return None
+            counts = [query_items.get(q, 0) for q in queries]
+        return zip(ranges, counts)
+
+    def _parse_field_facets(self, search, facet_items):
         '''
         Parses field facet counts like this:
             {'region': [('South America', 222),
@@ -302,51 +988,171 @@ class Searcher(object):
         '''
         facets = []
         for field, counts in facet_items.iteritems():
-            conf = self.field_facets[field]
-            label = conf.get('label', field.replace('_', ' ').title())
-            facet = Facet(field=field, label=label)
+            conf = self.field_facets.get(field)
+            if conf is None:
+                # e.g. the parent of a hierarchical facet
+                continue
+            facet = Facet(field=field, label=self._facet_label(field), multiselect=conf.get('multiselect', False))
             for count in counts:
                 item = FacetItem(count[0], count[1])
-                item.is_selected = self._is_selected_facet(field, item.value)
+                item.is_selected = self._is_selected_facet(search, field, item.value)
                 item.facet = facet
                 facet.items.append(item)
             facets.append(facet)       
         return facets
 
-    def _is_selected_facet(self, field, facet_value):
+    def _parse_pivot_facets(self, search, facet_items, field_items=None):
         '''
-        Checks the existing narrow_queries to check if a given field:value
-        exists, and is thus selected. Be careful not to modify facet_value
-        as it would be reflected in the facet.
+        Parses pivot facet counts like this:
+            {'region_exact,country_exact': [
+                {'field': 'region_exact', 'value': 'Asia', 'count': 134,
+                 'pivot': [{'field': 'country_exact', 'value': 'China', 'count': 40},
+                           {'field': 'country_exact', 'value': 'India', 'count': 38}]},
+                {'field': 'region_exact', 'value': 'Antarctica', 'count': 10}]}
+
+        into HierarchicalFacets. Backends without pivot faceting only count
+        the parent, which is looked up in field_items.
+        '''
+        field_items = field_items or {}
+        unified_index = connections['default'].get_unified_index()
+        facets = []
+        for field, conf in self.pivot_facets.iteritems():
+            child_field = conf['child']
+            key = ','.join(unified_index.get_facet_fieldname(f) for f in (field, child_field))
+            if key in facet_items:
+                pivots = facet_items[key]
+            elif field in field_items:
+                pivots = [{'value': value, 'count': count} for value, count in field_items[field]]
+            else:
+                continue
+
+            facet = HierarchicalFacet(field=field, label=self._facet_label(field),
+                                      multiselect=conf.get('multiselect', False),
+                                      child_field=child_field, child_label=conf.get('child_label'))
+            for pivot in pivots:
+                item = FacetItem(pivot['value'], pivot['count'])
+                item.is_selected = self._is_selected_facet(search, field, item.value)
+                item.facet = facet
+                facet.items.append(item)
+                for child_pivot in pivot.get('pivot', []):
+                    child = FacetItem(child_pivot['value'], child_pivot['count'])
+                    child.is_selected = self._is_selected_facet(search, child_field, child.value)
+                    facet.add_child(item, child)
+            facets.append(facet)
+        return facets
+
+    def _facet_label(self, field):
+        return self.facet_labels.get(field) or field.replace('_', ' ').title()
+
+    def _is_selected_facet(self, search, field, facet_value):
         '''
-        for narrow in self.queryset.query.narrow_queries:
-            value = self._solr_escape_value(facet_value)
-            if narrow.partition(':') == (field, ':', value) or \
-               narrow.partition(':') == ('%s_exact'%field, ':', value):
-                return True
-        return False
+        Checks the values the queryset was narrowed by to check if a given
+        field:value exists, and is thus selected. Be careful not to modify
+        facet_value as it would be reflected in the facet.
+        '''
+        value = self._solr_escape_value(facet_value)
+        return value in search.selected_values.get(field, ())
      
-    def _narrow_queryset(self, filters):
+    def _narrow_queryset(self, search, filters):
         '''
-        Helper to narrow a queryset using a dict of key-value pairs
+        Helper to narrow a queryset using a dict of key-value pairs. A list
+        of values narrows by any of them (OR). Filters on multi-select facets
+        are tagged so the facet can exclude them from its own counts.
         '''
-        if not filters: return
+        search.queryset, search.selected_values = self._narrowed(search.queryset, filters)
 
-        for field, value in filters.iteritems():
+    def _narrowed(self, queryset, filters):
+        '''
+        Returns the narrowed queryset and the (escaped) values selected
+        for each field.
+        '''
+        narrows, selected_values = self._narrows(filters)
+        for narrow in narrows:
+            queryset = queryset.narrow(narrow)
+        return queryset, selected_values
+
+    def _narrows(self, filters, tag=True):
+        '''
+        Returns the narrow queries for the filters and the (escaped) values
+        selected for each field. Unless tag is False, narrows carry local
+        params: a tag with the field name on multi-select facets and the
+        facet's filter cache hints (see FILTER_OPTIONS).
+
+        Values are sorted so that a selection makes the same narrow (and
+        so hits the same backend filter cache entry) whatever their order
+        in the URL.
+        '''
+        narrows = []
+        groups = {}
+        selected_values = {}
+        for field, value in sorted((filters or {}).iteritems()):
             # Generally, django-haystack will use the correct _exact field
             # for filtering on facets, but for custom query facets it doesn't
             # so we just make sure that the _exact field is used.
-            value = check_parse_date(value)
-            value = self._solr_escape_value(value)
-            field = '%s_exact' % field if self.indexed_fields[field].faceted else field
-            self.queryset = self.queryset.narrow('%(field)s:%(value)s' % { 'field':field, 'value':value})
-                                    
+            values = value if isinstance(value, (list, tuple)) else [value]
+            values = sorted(set(self._solr_escape_value(check_parse_date(v)) for v in values))
+            selected_values[field] = set(values)
+            index_field = '%s_exact' % field if self.indexed_fields[field].faceted else field
+            if field in self.date_range_fields and self._narrows_on_range_field(field, values):
+                index_field = self.date_range_fields[field]
+            options = self.filter_options.get(field, {})
+            params = []
+            if tag and field in self.multiselect_fields:
+                params.append('tag=%s' % field)
+            if tag and options.get('filter_cache') is False:
+                params.append('cache=false')
+                if 'filter_cost' in options:
+                    params.append('cost=%s' % options['filter_cost'])
+
+            rounded = values
+            if options.get('filter_round'):
+                rounded = sorted(set(round_date_range(v, options['filter_round']) for v in values))
+            if rounded != values:
+                # The rounded narrow is cached and shared by nearby ranges,
+                # the exact one only trims it so it isn't worth caching
+                narrows.append(self._local_params(self._narrow_query(index_field, rounded), params))
+                exact_params = params if not tag or 'cache=false' in params else params + ['cache=false']
+                narrows.append(self._local_params(self._narrow_query(index_field, values), exact_params))
+            elif options.get('filter_group') and not params:
+                groups.setdefault(options['filter_group'], []).append(self._narrow_query(index_field, values))
+            else:
+                narrows.append(self._local_params(self._narrow_query(index_field, values), params))
+
+        for group, queries in sorted(groups.iteritems()):
+            # Low-selectivity filters selected together take one filter
+            # cache entry rather than one each
+            narrows.append(queries[0] if len(queries) == 1 else ' AND '.join('(%s)' % q for q in queries))
+        return narrows, selected_values
+
+    def _narrows_on_range_field(self, field, values):
+        '''
+        True if a date facet's filter values can narrow on its range_field
+        (a CompactDateField): windows of at least its max_gap days contain
+        a date of any range they intersect, but shorter ones can fall
+        between two dates, so they narrow on the facet's own field.
+        '''
+        max_gap = getattr(self.indexed_fields.get(self.date_range_fields[field]), 'max_gap', None)
+        if max_gap is None:
+            return True
+        return all((date_range_days(value) or 0) >= max_gap for value in values)
+
+    def _narrow_query(self, index_field, values):
+        if len(values) == 1:
+            return '%s:%s' % (index_field, values[0])
+        return '%s:(%s)' % (index_field, ' OR '.join(values))
+
+    def _local_params(self, query, params):
+        if not params:
+            return query
+        return '{!%s}%s' % (' '.join(params), query)
+
     def _solr_escape_value(self, value):
         '''
         Escape Solr special characters
         '''
-        # ranges shouldn't have spaces escaped
-        if '[' in value: return value
+        # ranges (including the exclusive bounds of range facet buckets,
+        # e.g. {20 TO *]) shouldn't have spaces escaped
+        if QueryFacet.validate_range(value): return value
 
         ESCAPE_CHARS_RE = re.compile(r'(?<!\\)(?P<char>[&|+\-!(){}[\]^ "~*?:])')
 
@@ -0,0 +1,187 @@
+'''
+A read-only file of precomputed facet payloads for hot filter states,
+memory-mapped by every worker process so that they share one copy (the
+page cache) and a hit costs no network hop to a remote cache.
+
+The file is a header, an index of (key digest, offset, length) entries
+sorted by digest, and the pickled payloads. Lookups bisect the index in
+place, so the index isn't loaded into each process. Rebuilds are written to
+a temporary file and renamed over the snapshot, and readers reopen it when
+it changes; see the faceted_search_snapshot management command.
+
+Payloads carry the invalidation version of their state (see
+faceted_search.invalidation), so a Searcher with an invalidator stops
+using a state's snapshot facets once a document change invalidates it,
+until the next rebuild.
+'''
+import os
+import mmap
+import json
+import time
+import struct
+import logging
+import tempfile
+import threading
+import cPickle as pickle
+from hashlib import md5
+from collections import Counter
+
+from django.conf import settings
+
+from faceted_search.utils import run_parallel
+
+logger = logging.getLogger(__name__)
+
+# Path of the snapshot read by Searchers, None for no snapshot
+FACET_SNAPSHOT = getattr(settings, 'FACET_SNAPSHOT', None)
+# Seconds between checks for a rebuilt snapshot
+FACET_SNAPSHOT_CHECK_INTERVAL = getattr(settings, 'FACET_SNAPSHOT_CHECK_INTERVAL', 5)
+
+MAGIC = 'FSNP'
+# magic, number of entries
+HEADER = struct.Struct('<4sI')
+# md5 digest of the key, offset and length of the payload
+ENTRY = struct.Struct('<16sQI')
+
+
+def write_snapshot(path, payloads):
+    '''
+    Writes payloads (by facet cache key) to a snapshot at path, replacing
+    any existing snapshot atomically.
+    '''
+    entries = sorted((md5(key).digest(), pickle.dumps(payload, pickle.HIGHEST_PROTOCOL))
+                     for key, payload in payloads.iteritems())
+    directory = os.path.dirname(os.path.abspath(path))
+    f = tempfile.NamedTemporaryFile(dir=directory, prefix='.facet-snapshot-', delete=False)
+    try:
+        f.write(HEADER.pack(MAGIC, len(entries)))
+        offset = HEADER.size + ENTRY.size * len(entries)
+        for digest, data in entries:
+            f.write(ENTRY.pack(digest, offset, len(data)))
+            offset += len(data)
+        for digest, data in entries:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.chmod(f.name, 0644)
+        os.rename(f.name, path)
+    except:
+        f.close()
+        os.unlink(f.name)
+        raise
+    return len(entries)
+
+
+def build_snapshot(searcher, states, path, workers=4):
+    '''
+    Fetches the facets of states, (filters, keywords) pairs, with searcher
+    and writes them to a snapshot at path. The searcher shouldn't read a
+    snapshot itself.
+    '''
+    def fetch(state):
+        filters, keywords = state
+        search = searcher._prepare(filters, keywords)
+        search.queryset.query.set_limits(0, 0)
+        # Read before the counts are fetched, so an update meanwhile
+        # invalidates them
+        version = searcher.facet_state_version(search)
+        search.facets = searcher._facets(search)
+        if search.facets.degraded:
+            return None
+        return searcher.facet_cache_key(search), (search.hit_count, search.facets.encode(),
+                                                  search.facets.approximate, version)
+
+    payloads = dict(payload for payload in run_parallel(fetch, states, workers) if payload is not None)
+    return write_snapshot(path, payloads)
+
+
+def read_query_log(path, top=None, model=None):
+    '''
+    The most frequent (filters, keywords) states of a query log (see
+    faceted_search.querylog), optionally only those of model (its db_table)
+    '''
+    counts = Counter()
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if model is not None and record.get('model') != model:
+                continue
+            filters = tuple(sorted((field, tuple(value) if isinstance(value, list) else value)
+                                   for field, value in record.get('filters', {}).iteritems()))
+            counts[(filters, record.get('keywords') or '')] += 1
+    return [(dict((field, list(value) if isinstance(value, tuple) else value) for field, value in filters), keywords)
+            for (filters, keywords), count in counts.most_common(top)]
+
+
+class FacetSnapshot(object):
+    '''
+    Reads payloads from the snapshot at path, reopening it when a rebuild
+    replaces it (checked at most every check_interval seconds). Missing
+    or invalid snapshots have no payloads.
+    '''
+    def __init__(self, path, check_interval=FACET_SNAPSHOT_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        # (stat identity, mmap, number of entries)
+        self.current = (None, None, 0)
+        self.checked = 0
+
+    def get(self, key):
+        identity, data, count = self._current()
+        if not count:
+            return None
+        digest = md5(key).digest()
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            entry_digest, offset, length = ENTRY.unpack_from(data, HEADER.size + middle * ENTRY.size)
+            if entry_digest < digest:
+                low = middle + 1
+            elif entry_digest > digest:
+                high = middle
+            else:
+                return pickle.loads(data[offset:offset + length])
+        return None
+
+    def __len__(self):
+        return self._current()[2]
+
+    def _current(self):
+        now = time.time()
+        if now - self.checked >= self.check_interval:
+            with self.lock:
+                if now - self.checked >= self.check_interval:
+                    self.checked = now
+                    self._reopen()
+        return self.current
+
+    def _reopen(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.current = (None, None, 0)
+            return
+        identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if identity == self.current[0]:
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, count = HEADER.unpack_from(data)
+            if magic != MAGIC:
+                raise ValueError('Not a facet snapshot')
+        except (IOError, ValueError, struct.error, mmap.error) as e:
+            logger.error('Could not open facet snapshot %s: %s' % (self.path, e))
+            self.current = (identity, None, 0)
+            return
+        # The previous map is closed once no reader is using it
+        self.current = (identity, data, count)
+        logger.info('Opened facet snapshot %s with %d states' % (self.path, count))
+
+
+default_snapshot = FacetSnapshot(FACET_SNAPSHOT) if FACET_SNAPSHOT else None
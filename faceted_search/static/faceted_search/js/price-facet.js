@@ -9,10 +9,13 @@ $(document).ready(function() {
     //var item_count = '{{ item.count }}';
     //var price_field = '{{ price_field }}';
     //var price_query = '{{ item.value }}';
+    //var currency_code = '{{ currency.code }}';
+    //var histogram_url = '{{ histogram_url }}';
     var url_params = get_url_params(item_url.replace(item_base_url, ''));
     var price_values = parse_facet_query(price_query);
     var price_start = price_values ? price_values[0] : SLIDER_MIN
     var price_end = price_values ? price_values[1] : SLIDER_MAX;
+    var histogram = null;
 
     function get_url_params(query) {
         /*
@@ -39,10 +42,13 @@ $(document).ready(function() {
 
     function parse_facet_query(facet_query) {
         /*
-         * Parse a facet query in the form [n TO n]
+         * Parse a facet query in the form [n TO n] (or [n TO n}, {n TO *]
+         * and [* TO n} for range facets). Open ends are the slider's ends.
          */
-        if(Array.isArray(facet_query.match(/(\[\d+ TO \d+\])/gi))) {
-            return facet_query.replace(/[\[\] ]+/g,'').split(/TO/i);
+        var match = facet_query.match(/^[\[{](\d+|\*) TO (\d+|\*)[\]}]$/i);
+        if(match) {
+            return [match[1] == '*' ? SLIDER_MIN : match[1],
+                    match[2] == '*' ? SLIDER_MAX : match[2]];
         }
 
         return null;
@@ -86,6 +92,21 @@ $(document).ready(function() {
         return $.param(params);
     }
 
+    function get_histogram_count(start_range, end_range) {
+        /*
+         * Sum the histogram buckets that fall within a start and end
+         * range. The last bucket is open-ended (upper bound of null).
+         */
+        var count = 0;
+        $.each(histogram.histogram, function(i, bucket) {
+            var lower = bucket[0], upper = bucket[1];
+            if(lower >= start_range && (end_range == SLIDER_MAX || (upper !== null && upper <= end_range))) {
+                count += bucket[2];
+            }
+        });
+        return count;
+    }
+
     $("#slider_min_price").slider({
         range: true,
         min: SLIDER_MIN,
@@ -100,12 +121,19 @@ $(document).ready(function() {
             $('#min_price').html(get_min_price_label(ui.values[0], ui.values[1]));
             $('#min_price').append(get_min_price_count_element());
             $('#min_price_count').html(min_price_count_html);
+            if(histogram) {
+                $('#min_price_count').html('(' + get_histogram_count(ui.values[0], ui.values[1]) + ')');
+            }
         },
         change: function(event, ui) {
 
         },
         stop: function(event, ui) {
             $('#min_price').attr('href',item_base_url + '?' + get_min_price_qs(ui.values[0], ui.values[1]));
+            if(histogram) {
+                /* Counts are already shown from the histogram */
+                return;
+            }
             /* Grab the search count for the new min_price query */
             $.ajax({
                 dataType: "html",
@@ -123,4 +151,18 @@ $(document).ready(function() {
     $('#min_price').append(get_min_price_count_element());
     $('#min_price_count').html('(' + item_count + ')');
     $('#min_price').attr('href', item_url);
+    if(histogram_url) {
+        /* Fetch the price histogram for the current filters for live counts */
+        var histogram_params = $.extend({}, url_params, {currency: currency_code});
+        delete histogram_params[price_field];
+        $.ajax({
+            url: histogram_url,
+            dataType: "json",
+            traditional: true,
+            data: histogram_params,
+            success: function (data) {
+                histogram = data;
+            }
+        });
+    }
 });   
@@ -4,12 +4,18 @@ from django.contrib.admin.templatetags.admin_list import result_list
 from django.core.urlresolvers import reverse
 from django.utils.safestring import mark_safe
 from django.conf import settings
+
+from faceted_search.cache import get_currency
+
 register = Library()
 
 logger = logging.getLogger(__name__)
 
+# Optional url name of a PriceHistogramView, used by the price slider for live counts
+PRICE_HISTOGRAM_URL_NAME = getattr(settings, 'PRICE_HISTOGRAM_URL_NAME', None)
+
 def get_facets(facet_list, facet_field=None, sort_by=None):
-    facets = {'facets':facet_list}
+    facets = {'facets':facet_list, 'degraded': getattr(facet_list, 'degraded', False)}
     if facet_field:
         facet = facet_list.get(facet_field, None)
         if facet:
@@ -28,6 +34,14 @@ def get_facets(facet_list, facet_field=None, sort_by=None):
 def show_facets(facet_list, facet_field=None, sort_by=None):
     return get_facets(facet_list, facet_field, sort_by)
 
+@register.inclusion_tag("faceted_search/hierarchical_facets.html")
+def show_hierarchical_facets(facet_list, facet_field=None, sort_by=None):
+    '''
+    Hierarchical facets (see HierarchicalFacet) with each item's children
+    nested beneath it
+    '''
+    return get_facets(facet_list, facet_field, sort_by)
+
 @register.inclusion_tag("faceted_search/facets_select.html")
 def show_facets_as_select(facet_list, facet_field=None, sort_by=None):
     return get_facets(facet_list, facet_field, sort_by)
@@ -46,11 +60,13 @@ def show_price_facets(context, facet_list, facet_field=None, sort_by=None):
     A widget for showing price range selection in faceted search
     '''
     tag_context = show_facets(facet_list, facet_field, sort_by)
+    currency = context.get('currency') or get_currency()
     
     tag_context.update({
-        'currency': context['currency'],
+        'currency': currency,
         'slider_max': settings.PRICE_FACET_MAX,
-        'price_field': ''.join((settings.PRICE_FACET_ROOT,'_',context['currency'].code,)),
+        'price_field': ''.join((settings.PRICE_FACET_ROOT,'_',currency.code,)),
+        'histogram_url': reverse(PRICE_HISTOGRAM_URL_NAME) if PRICE_HISTOGRAM_URL_NAME else '',
     })
 
     return tag_context
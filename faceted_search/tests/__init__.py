@@ -4,7 +4,33 @@ from .tests import (
     FacetListTestCase,
     FacetTestCase,
     QueryFacetTestCase,
+    HierarchicalFacetTestCase,
     FacetItemTestCase,
+    CurrencyCacheTestCase,
+    CacheKeyTestCase,
+    LabelCacheTestCase,
+    ReentrantSearcherTestCase,
+    SearchManyTestCase,
+    FederatedSearcherTestCase,
+    ApproximateFacetsTestCase,
+    HistogramTestCase,
+    FacetTypeaheadViewTestCase,
+    StoredResultTestCase,
+    ChecksTestCase,
+    FacetPrefetcherTestCase,
+    PrefetchedFacetsTestCase,
+    LoadTestTestCase,
+    QueryLogTestCase,
+    MultiValueDateFieldTestCase,
+    CompactDateFieldTestCase,
+    DegradedFacetsTestCase,
+    DeferredFacetsTestCase,
+    NarrowsTestCase,
+    FacetCacheInvalidatorTestCase,
+    FacetSnapshotTestCase,
+    SnapshotSearchTestCase,
+    RunParallelTestCase,
+    FacetValueIndexTestCase,
 )
 
 from .factories import (
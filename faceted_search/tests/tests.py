@@ -1,10 +1,29 @@
 # -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import shutil
 import logging
+import datetime
+import tempfile
+import threading
 from urllib import urlencode
 from collections import OrderedDict
 
 from django.utils import unittest
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
 from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404
+from django.contrib.sites.models import Site
+from django.contrib.auth.models import Group
+
+from haystack import connections, indexes
+from haystack.exceptions import SearchFieldError
+from haystack.utils.loading import UnifiedIndex
 
 from currencies.tests import CurrencyFactory
 from faceted_search.tests.factories import (
@@ -12,10 +31,83 @@ from faceted_search.tests.factories import (
     FacetFactory,
     FacetItemFactory,
 )
-from faceted_search.facets import FacetList, Facet, QueryFacet, FacetItem
+from faceted_search.facets import FacetList, Facet, QueryFacet, HierarchicalFacet, FacetItem
+from faceted_search.cache import get_currency, clear_currency_cache, make_cache_key, FacetCache
+from faceted_search.utils import build_ranges, run_parallel, humanize_range, LabelCache
+from faceted_search.searcher import Searcher, Search, StoredResult
+from faceted_search.federated import FederatedSearcher
+from faceted_search.checks import check_facets, check_sort_config, check_sort_order
+from faceted_search.prefetch import FacetPrefetcher
+from faceted_search.loadtest import percentile, facet_count_errors
+from faceted_search.querylog import QueryLog
+from faceted_search.fields import MultiValueDateField, CompactDateField, SampleField, compress_dates
+from faceted_search import typeahead
+from faceted_search.typeahead import FacetValueIndex
+from faceted_search.invalidation import FacetCacheInvalidator, state_version_keys
+from faceted_search.snapshot import FacetSnapshot, write_snapshot, build_snapshot
+from faceted_search.views import PriceHistogramView, FacetTypeaheadView, StreamingSearchView
+from faceted_search.backends import solr_backend
+from faceted_search.backends.solr_backend import FacetedSolrSearchBackend
 
 logger = logging.getLogger(__name__)
 
+class StubIndex(indexes.SearchIndex):
+    '''
+    The index searched by StubBackendTestCases. It isn't Indexable, so
+    it's only used by their connection.
+    '''
+    text = indexes.CharField(document=True)
+    name = indexes.CharField(stored=True)
+    region = indexes.CharField(faceted=True)
+    country = indexes.CharField(faceted=True)
+    duration = indexes.IntegerField(faceted=True)
+    min_price_USD = indexes.IntegerField(faceted=True)
+    departure_dates = MultiValueDateField(faceted=True)
+    departure_ranges = CompactDateField()
+    sample = SampleField()
+
+    def get_model(self):
+        return Site
+
+class StubGroupIndex(StubIndex):
+    def get_model(self):
+        return Group
+
+class StubBackendTestCase(unittest.TestCase):
+    '''
+    Runs searches against the stub backend with StubIndex, recording the
+    (query string, kwargs) of each request in self.requests. Responses
+    have the canned facet counts of `facets`; override respond() to vary
+    them by request.
+    '''
+    facets = {}
+    hits = 120
+
+    def setUp(self):
+        self.connection_options = connections.connections_info['default']
+        connections.connections_info['default'] = {
+            'ENGINE': 'faceted_search.backends.stub_backend.StubEngine',
+            'FACETS': self.facets,
+            'HITS': self.hits,
+        }
+        engine = connections.reload('default')
+        engine._index = UnifiedIndex()
+        engine._index.build(indexes=[StubIndex(), StubGroupIndex()])
+        backend = engine.get_backend()
+        stub_search = backend.search
+        self.requests = []
+        def search(query_string, **kwargs):
+            self.requests.append((query_string, kwargs))
+            return self.respond(query_string, kwargs, stub_search(query_string, **kwargs))
+        backend.search = search
+
+    def tearDown(self):
+        connections.connections_info['default'] = self.connection_options
+        connections.reload('default')
+
+    def respond(self, query_string, kwargs, response):
+        return response
+
 class FacetListTestCase(unittest.TestCase):
     def setUp(self):
         self.ITEM_VALUE = '[0 TO 500]'
@@ -78,6 +170,48 @@ class FacetListTestCase(unittest.TestCase):
             urlencode({self.facet_list.facets[1].field: self.facet_list.facets[1].items[0].value})
         )
 
+    def test_creates_url_params_for_multiselect_facets(self):
+        facet = FacetFactory.build(field='region', multiselect=True)
+        for value, is_selected in (('Africa', True), ('Asia', True), ('Europe', False)):
+            facet_item = FacetItemFactory.build(value=value, is_selected=is_selected)
+            facet_item.facet = facet
+            facet.items.append(facet_item)
+        facet_list = FacetList()
+        facet_list.append(facet)
+
+        # should repeat the field for each selected value
+        self.assertEqual(
+            facet_list.url_param(),
+            'region=Africa&region=Asia',
+        )
+
+        # should add an unselected value rather than replace the selection
+        self.assertEqual(
+            facet_list.url_param(facet_item=facet.items[2]),
+            'region=Africa&region=Asia&region=Europe',
+        )
+
+        # should only remove the excluded value
+        self.assertEqual(
+            facet_list.url_param(facet_item=facet.items[0], include_facet_item=False),
+            'region=Asia',
+        )
+
+    def test_encodes_and_decodes(self):
+        self.facet_list.facets[0].multiselect = True
+        decoded = FacetList.decode(self.facet_list.encode(), extra_params={'q': 'peru'})
+
+        self.assertEqual(decoded.extra_params, {'q': 'peru'})
+        self.assertEqual(
+            [(f.field, f.label, f.multiselect, f.__class__) for f in decoded],
+            [(f.field, f.label, f.multiselect, f.__class__) for f in self.facet_list],
+        )
+        self.assertEqual(
+            [[(i.value, i.label, i.count, i.is_selected) for i in f] for f in decoded],
+            [[(i.value, i.label, i.count, i.is_selected) for i in f] for f in self.facet_list],
+        )
+        self.assertTrue(all(i.facet is f for f in decoded for i in f))
+
 class FacetTestCase(unittest.TestCase):
     def setUp(self):
         pass
@@ -107,6 +241,68 @@ class QueryFacetTestCase(unittest.TestCase):
         self.assertTrue(QueryFacet.validate_range(self.price_range))
         self.assertTrue(QueryFacet.validate_range(self.date_range))
         self.assertFalse(QueryFacet.validate_range('I Am Not A Range'))
+        self.assertTrue(QueryFacet.validate_range('[* TO 500}'))
+        self.assertTrue(QueryFacet.validate_range('{2000 TO *]'))
+
+    def test_sorts_range_values(self):
+        facet = QueryFacet(field='duration', label='Duration')
+        for lower, upper, query in reversed(build_ranges(5, 15, 5, before=True, after=True)):
+            facet.items.append(FacetItem(query, 0))
+        facet.sort_by_value()
+        self.assertEqual(
+            [item.value for item in facet.items],
+            ['[* TO 5}', '[5 TO 10}', '[10 TO 15]', '{15 TO *]'],
+        )
+
+class HierarchicalFacetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.facet = HierarchicalFacet(field='region', label='Region', child_field='country')
+        for region, countries in (('Asia', ('China', 'India')), ('Europe', ('Austria',))):
+            item = FacetItem(region, 10)
+            item.facet = self.facet
+            self.facet.items.append(item)
+            for country in countries:
+                self.facet.add_child(item, FacetItem(country, 5))
+        self.facet_list = FacetList()
+        self.facet_list.append(self.facet)
+        self.india = self.facet.items[0].children[1]
+
+    def test_creates_url_params_for_children(self):
+        # selecting a child should select its parent as well
+        self.assertEqual(self.india.url_param(), 'region=Asia&country=India')
+
+        self.facet.items[0].is_selected = True
+        self.india.is_selected = True
+        self.assertEqual(self.facet.selected_items(), [self.facet.items[0], self.india])
+
+        # removing the parent should remove its children
+        self.assertEqual(self.facet.items[0].url_param(include_self=False), '')
+        self.assertEqual(self.india.url_param(include_self=False), 'region=Asia')
+
+    def test_looks_up_children(self):
+        self.assertTrue(self.facet_list['country'] is self.facet.child)
+        self.assertTrue('country' in self.facet_list)
+        self.assertEqual([i.value for i in self.facet_list['country']], ['China', 'India', 'Austria'])
+        self.assertRaises(KeyError, self.facet_list.__getitem__, 'city')
+
+    def test_replaces_top_level_facets_only(self):
+        self.assertRaises(KeyError, self.facet_list.__setitem__, 'country', Facet('country', 'Country'))
+        self.assertTrue(self.facet_list['country'] is self.facet.child)
+
+        region = Facet('region', 'Region')
+        self.facet_list['region'] = region
+        self.assertEqual(list(self.facet_list), [region])
+        self.assertRaises(KeyError, self.facet_list.__getitem__, 'country')
+
+    def test_encodes_and_decodes(self):
+        decoded = FacetList.decode(self.facet_list.encode())['region']
+        self.assertTrue(isinstance(decoded, HierarchicalFacet))
+        self.assertEqual(decoded.child.field, 'country')
+        self.assertEqual(
+            [(i.value, [c.value for c in i.children]) for i in decoded],
+            [('Asia', ['China', 'India']), ('Europe', ['Austria'])],
+        )
+        self.assertEqual(decoded.items[0].children[1].url_param(), 'region=Asia&country=India')
 
 class FacetItemTestCase(unittest.TestCase):
     def setUp(self):
@@ -176,4 +372,732 @@ class FacetItemTestCase(unittest.TestCase):
                 ''.join((base_url, '?', urlencode(selected_facets),))
         )
 
+class CurrencyCacheTestCase(TestCase):
+    def setUp(self):
+        clear_currency_cache()
+
+    def test_caches_currency_lookups(self):
+        currency = get_currency()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_currency(), currency)
+            FacetItem.price_label_from_query('[500 TO 1000]')
+
+    def test_invalidates_on_save(self):
+        get_currency().save()
+        with self.assertNumQueries(1):
+            get_currency()
+
+class CacheKeyTestCase(unittest.TestCase):
+    def test_makes_canonical_cache_keys(self):
+        self.assertEqual(
+            make_cache_key('histogram', {'region': ['Asia', 'Africa'], 'country': 'Peru'}),
+            make_cache_key('histogram', {'country': 'Peru', 'region': ['Africa', 'Asia']}),
+        )
+        self.assertNotEqual(
+            make_cache_key('histogram', {'region': 'Asia'}),
+            make_cache_key('histogram', {'region': 'Africa'}),
+        )
+        self.assertEqual(
+            make_cache_key('histogram', {'region': 'Asia'}),
+            make_cache_key('histogram', {'region': ['Asia']}),
+        )
+
+class LabelCacheTestCase(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        built = []
+        def build(value):
+            built.append(value)
+            return value.upper()
+        labels = LabelCache(size=2)
+        self.assertEqual(labels.get('test', build, 'a'), 'A')
+        labels.get('test', build, 'b')
+        labels.get('test', build, 'a')
+        labels.get('test', build, 'c')
+        self.assertEqual(labels.get('test', build, 'a'), 'A')
+        labels.get('test', build, 'b')
+        self.assertEqual(built, ['a', 'b', 'c', 'b'])
+
+    def test_humanizes_ranges(self):
+        self.assertEqual(humanize_range('[* TO 500]'), 'Less than 500')
+        self.assertEqual(humanize_range('[500 TO 1000]'), '500 to 1000')
+        self.assertEqual(humanize_range('[1000 TO *]'), '1000 and up')
+
+class ReentrantSearcherTestCase(StubBackendTestCase):
+    facets = {'fields': {'region_exact': [['Asia', 40], ['Europe', 30], ['Africa', 3]]}}
+
+    def respond(self, query_string, kwargs, response):
+        # Let the searches overlap
+        time.sleep(0.01)
+        return response
+
+    def test_searches_concurrently(self):
+        searcher = Searcher(model=Site, facets={'fields': {'region': {}}})
+        regions = ['Asia', 'Europe', 'Africa'] * 4
+        searches = run_parallel(lambda region: searcher.search({'region': region}, region.lower()),
+                                regions, len(regions))
+        for region, search in zip(regions, searches):
+            self.assertEqual(search.cleaned_filters, {'region': region})
+            self.assertEqual([i.value for i in search.facets.selected_facet_items()], [region])
+            self.assertEqual(search.facets.url_param(), urlencode([('q', region.lower()), ('region', region)]))
+        for query_string, kwargs in self.requests:
+            region = [narrow.split(':')[1] for narrow in kwargs['narrow_queries']]
+            self.assertEqual(len(region), 1)
+            self.assertTrue(region[0].lower() in query_string)
+
+class SearchManyTestCase(StubBackendTestCase):
+    facets = {'fields': {'region_exact': [['Asia', 40], ['Europe', 30]]}}
+
+    def respond(self, query_string, kwargs, response):
+        if 'hiking' in query_string:
+            counts = {'(region_exact:Europe)': 7}
+        else:
+            counts = {'(region_exact:Asia)': 40, '(duration_exact:[5 TO 10}) AND (region_exact:Europe)': 12}
+        response['facets']['queries'] = dict((q, counts.get(q, 0)) for q in kwargs.get('raw_query_facets', []))
+        return response
+
+    def test_counts_states_by_keywords(self):
+        searcher = Searcher(model=Site, facets={'fields': {'region': {}}})
+        searches = searcher.search_many([
+            {'region': 'Asia'},
+            {'region': 'Europe', 'q': 'hiking'},
+            {'region': 'Europe', 'duration': '[5 TO 10}'},
+            {'region': 'Africa'},
+            {},
+        ], facets=False)
+        self.assertEqual([search.hit_count for search in searches], [40, 7, 12, 0, 120])
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(sorted(self.requests[0][1]['raw_query_facets'] + self.requests[1][1]['raw_query_facets']), [
+            '(duration_exact:[5 TO 10}) AND (region_exact:Europe)',
+            '(region_exact:Africa)',
+            '(region_exact:Asia)',
+            '(region_exact:Europe)',
+        ])
+
+    def test_prefers_own_keywords(self):
+        searches = Searcher(model=Site).search_many([{'region': 'Europe', 'q': 'hiking'}, {'region': 'Asia'}],
+                                                    keywords='tour', facets=False)
+        self.assertEqual([search.keywords for search in searches], ['hiking', 'tour'])
+        self.assertEqual([search.hit_count for search in searches], [7, 40])
+        self.assertEqual(sorted(query_string for query_string, kwargs in self.requests), ['text:(hiking)', 'text:(tour)'])
+
+        searches = Searcher(model=Site).search_many([{'region': 'Europe', 'q': 'hiking'}], keywords='tour')
+        self.assertEqual(searches[0].keywords, 'hiking')
+        self.assertEqual(self.requests[-1][0], 'text:(hiking)')
+
+    def test_fetches_facets_of_each_state(self):
+        searches = Searcher(model=Site, facets={'fields': {'region': {}}}).search_many([{'region': 'Asia'}, {}])
+        self.assertEqual([search.hit_count for search in searches], [120, 120])
+        self.assertEqual([search.facets.has_selected() for search in searches], [True, False])
+        self.assertEqual(len(self.requests), 2)
+
+class FederatedSearcherTestCase(StubBackendTestCase):
+    facets = {'fields': {'region_exact': [['Asia', 40]], 'country_exact': [['Peru', 8]]}}
+
+    def setUp(self):
+        super(FederatedSearcherTestCase, self).setUp()
+        self.lock = threading.Lock()
+        self.running = self.most_running = 0
+        self.searcher = FederatedSearcher([
+            Searcher(model=Site, facets={'fields': {'region': {}, 'country': {}}}),
+            (Group, {'fields': {'country': {}}}),
+        ], results=0)
+
+    def respond(self, query_string, kwargs, response):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(0.02)
+        with self.lock:
+            self.running -= 1
+        return response
+
+    def test_searches_models_concurrently(self):
+        search = self.searcher.search({'country': 'Peru'})
+        self.assertEqual(self.most_running, 2)
+        self.assertEqual([name for name, model_search in search], ['site', 'group'])
+        self.assertEqual(search.hit_counts, OrderedDict([('site', 120), ('group', 120)]))
+        self.assertEqual(search.hit_count, 240)
+        self.assertEqual(search.facets['group']['country'].selected_items()[0].value, 'Peru')
+        self.assertEqual([kwargs['narrow_queries'] for query_string, kwargs in self.requests],
+                         [set(['country_exact:Peru'])] * 2)
+
+    def test_routes_filters(self):
+        search = self.searcher.search({'region': 'Asia', 'page': '2'})
+        self.assertEqual(search['site'].cleaned_filters, {'region': 'Asia'})
+        self.assertEqual(search['group'].hit_count, 0)
+        self.assertEqual(list(search['group']), [])
+        self.assertEqual(search.hit_count, 120)
+        self.assertEqual(len(self.requests), 1)
+
+        # Filters without values don't restrict any model
+        search = self.searcher.search({'region': [''], 'q': 'hiking'})
+        self.assertEqual(search.hit_counts, OrderedDict([('site', 120), ('group', 120)]))
+        self.assertTrue(all('hiking' in query_string for query_string, kwargs in self.requests[1:]))
+
+class ApproximateFacetsTestCase(StubBackendTestCase):
+    facets = {
+        'fields': {'duration_exact': [['10', 3]]},
+        'pivots': {'region_exact,country_exact': [
+            {'field': 'region_exact', 'value': 'Asia', 'count': 4,
+             'pivot': [{'field': 'country_exact', 'value': 'China', 'count': 2}]}]},
+    }
+    sampled_hits = 50
+
+    def setUp(self):
+        super(ApproximateFacetsTestCase, self).setUp()
+        cache.clear()
+        self.searcher = Searcher(model=Site, facets={'fields': {'duration': {}}, 'pivots': {'region': {'child': 'country'}}},
+                                 facet_cache=FacetCache(), approximate_threshold=100, sample_rate=0.1)
+
+    def respond(self, query_string, kwargs, response):
+        if 'sample:[0 TO 9]' in kwargs.get('narrow_queries', ()):
+            response['hits'] = self.sampled_hits
+        return response
+
+    def counts(self, facets):
+        return [(i.value, i.count) for i in facets['duration']] + \
+               [(i.value, i.count, [(c.value, c.count) for c in i.children]) for i in facets['region']]
+
+    def test_scales_sampled_counts(self):
+        search = self.searcher.search()
+        self.assertEqual(len(self.requests), 1)
+        self.assertTrue('sample:[0 TO 9]' in self.requests[0][1]['narrow_queries'])
+        self.assertEqual(search.hit_count, 500)
+        self.assertTrue(search.facets.approximate)
+        self.assertTrue(search.facets['country'].items[0].approximate)
+        self.assertEqual(self.counts(search.facets), [('10', 30), ('Asia', 40, [('China', 20)])])
+
+        # from the facet cache
+        search = self.searcher.search()
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(search.hit_count, 500)
+        self.assertTrue(search.facets.approximate)
+        self.assertEqual(self.counts(search.facets), [('10', 30), ('Asia', 40, [('China', 20)])])
+
+    def test_counts_exactly_below_the_threshold(self):
+        self.sampled_hits = 5
+        search = self.searcher.search()
+        self.assertEqual(len(self.requests), 2)
+        self.assertFalse(any(n.startswith('sample:') for n in self.requests[1][1].get('narrow_queries', ())))
+        self.assertEqual(search.hit_count, 120)
+        self.assertFalse(search.facets.approximate)
+        self.assertEqual(self.counts(search.facets), [('10', 3), ('Asia', 4, [('China', 2)])])
+
+class HistogramTestCase(StubBackendTestCase):
+    facets = {'ranges': {'min_price_USD_exact': {'counts': [['0', 3], ['50', 5]], 'after': 2}}}
+
+    def setUp(self):
+        super(HistogramTestCase, self).setUp()
+        cache.clear()
+
+    def respond(self, query_string, kwargs, response):
+        response['stats'] = {'min_price_USD': {'min': 20.0, 'max': 480.0, 'count': 10}}
+        return response
+
+    def test_counts_buckets_without_the_field_filter(self):
+        filters = {'min_price_USD': '[0 TO 50]', 'region': 'Asia'}
+        result = Searcher(model=Site).histogram('min_price_USD', 0, 100, 50, filters)
+        self.assertEqual(result, {
+            'field': 'min_price_USD',
+            'min': 20.0,
+            'max': 480.0,
+            'count': 10,
+            'histogram': [(0, 50, 3), (50, 100, 5), (100, None, 2)],
+        })
+        query_string, kwargs = self.requests[0]
+        self.assertEqual(kwargs['narrow_queries'], set(['region_exact:Asia']))
+        self.assertEqual(kwargs['stats'], {'min_price_USD': []})
+        self.assertEqual(kwargs['end_offset'], 0)
+
+        # cached per filter state
+        Searcher(model=Site).histogram('min_price_USD', 0, 100, 50, {'region': 'Asia'})
+        self.assertEqual(len(self.requests), 1)
+
+    @override_settings(PRICE_FACET_ROOT='min_price', PRICE_FACET_MAX=100, DEFAULT_CURRENCY_CODE='USD')
+    def test_returns_json(self):
+        view = PriceHistogramView.as_view(model=Site, gap=50)
+        response = view(RequestFactory().get('/prices/', {'region': 'Asia', 'currency': 'USD'}))
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.content)['histogram'], [[0, 50, 3], [50, 100, 5], [100, None, 2]])
+        self.assertRaises(Http404, view, RequestFactory().get('/prices/', {'currency': 'EUR'}))
+
+class FacetTypeaheadViewTestCase(StubBackendTestCase):
+    facets = {
+        'fields': {'country_exact': [['Zambia', 31], ['Zanzibar', 12], ['China', 20]]},
+        'queries': {'country_exact:Zambia': 9, 'country_exact:Zanzibar': 0},
+    }
+
+    def setUp(self):
+        super(FacetTypeaheadViewTestCase, self).setUp()
+        typeahead._indexes.clear()
+
+    def test_looks_up_pivot_children(self):
+        view = FacetTypeaheadView.as_view(model=Site, facets={'pivots': {'region': {'child': 'country'}}})
+        response = view(RequestFactory().get('/facet-values/', {'field': 'country', 'prefix': 'za', 'region': 'Africa'}))
+        self.assertEqual(json.loads(response.content)['values'], [{'value': 'Zambia', 'count': 9}])
+        self.assertEqual(self.requests[-1][1]['narrow_queries'], set(['region_exact:Africa']))
+        self.assertRaises(Http404, view, RequestFactory().get('/facet-values/', {'field': 'duration', 'prefix': '1'}))
+
+class StoredResultTestCase(StubBackendTestCase, TestCase):
+    hits = 2
+
+    def respond(self, query_string, kwargs, response):
+        documents = [('1', 'Inca Trail'), ('2', 'Everest Base Camp')]
+        response['results'] = [kwargs['result_class']('sites', 'site', pk, 1.0, name=name)
+                               for pk, name in documents[kwargs['start_offset']:kwargs.get('end_offset')]]
+        return response
+
+    def test_builds_from_stored_fields(self):
+        result = StoredResult('trips', 'trip', '1', 1.0, name='Inca Trail', duration=5)
+        self.assertEqual(result.pk, '1')
+        self.assertEqual(result.name, 'Inca Trail')
+        self.assertEqual(result.duration, 5)
+        self.assertFalse(hasattr(result, 'object'))
+
+    def test_searches_stored_fields(self):
+        search = Searcher(model=Site, stored_fields=['name']).search()
+        with self.assertNumQueries(0):
+            results = [(result.__class__, result.pk, result.name) for result in search]
+        self.assertEqual(results, [(StoredResult, '1', 'Inca Trail'), (StoredResult, '2', 'Everest Base Camp')])
+
+        query_string, kwargs = self.requests[-1]
+        backend = FacetedSolrSearchBackend('default', URL='http://localhost:8983/solr')
+        self.assertEqual(backend.build_search_kwargs(query_string, fields=kwargs['fields'])['fl'],
+                         'id django_ct django_id score name')
+
+class ChecksTestCase(unittest.TestCase):
+    def setUp(self):
+        class Field(object):
+            def __init__(self, faceted=True):
+                self.faceted = faceted
+        self.indexed_fields = {
+            'region': Field(),
+            'country': Field(),
+            'duration': Field(),
+            'name': Field(faceted=False),
+        }
+
+    def test_checks_facets(self):
+        self.assertEqual(check_facets({
+            'fields': {'region': {}, 'country': {}},
+            'ranges': {'duration': {'start': 0, 'end': 40, 'gap': 5}},
+        }, self.indexed_fields), [])
+        self.assertEqual(len(check_facets({
+            'fields': {'name': {}, 'tag': {}},
+            'ranges': {'duration': {'start': 0, 'gap': 5}},
+            'bogus': {},
+        }, self.indexed_fields)), 4)
+
+    def test_checks_sort_config(self):
+        self.assertEqual(check_sort_config((
+            {'field': 'name', 'default': True},
+            {'field': 'name', 'reverse': True},
+        ), self.indexed_fields), [])
+        self.assertEqual(len(check_sort_config((
+            {'field': 'name', 'default': True},
+            {'field': 'name', 'default': True},
+            {'field': 'byName'},
+        ), self.indexed_fields)), 3)
+
+    def test_checks_sort_order(self):
+        self.assertEqual(check_sort_order(['region', 'country'], self.indexed_fields), [])
+        self.assertEqual(
+            check_sort_order(['region' 'country'], self.indexed_fields),
+            ["Unknown field 'regioncountry' in FACET_SORT_ORDER (missing a comma?)"],
+        )
+
+class FacetPrefetcherTestCase(unittest.TestCase):
+    def test_picks_top_unselected_items(self):
+        class LastSearch(object):
+            facets = FacetList()
+        for field, counts in (('region', (('Asia', 40), ('Europe', 30))), ('activity', (('Hiking', 35), ('Rafting', 5)))):
+            facet = Facet(field, field.title())
+            for value, count in counts:
+                item = FacetItem(value, count)
+                item.facet = facet
+                facet.items.append(item)
+            LastSearch.facets.append(facet)
+        LastSearch.facets['region'].items[0].is_selected = True
+
+        self.assertEqual(FacetPrefetcher(states=2).next_states(LastSearch), [
+            {'region': ['Asia'], 'activity': ['Hiking']},
+            {'region': ['Europe']},
+        ])
+        self.assertEqual(FacetPrefetcher(states=2, fields=('region',)).next_states(LastSearch), [
+            {'region': ['Europe']},
+        ])
+
+class PrefetchedFacetsTestCase(StubBackendTestCase):
+    facets = {'fields': {'region_exact': [['Asia', 40], ['Europe', 30]]}}
+
+    def setUp(self):
+        super(PrefetchedFacetsTestCase, self).setUp()
+        cache.clear()
+
+    def test_searches_hit_prefetched_states(self):
+        searcher = Searcher(model=Site, facets={'fields': {'region': {}}}, facet_cache=FacetCache())
+        # as built by FacetPrefetcher.next_states()
+        searcher.prefetch_facets({'region': ['Asia']})
+        self.assertEqual(len(self.requests), 1)
+
+        search = searcher.search({'region': 'Asia'})
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual([i.value for i in search.facets.selected_facet_items()], ['Asia'])
+
+class LoadTestTestCase(unittest.TestCase):
+    def test_percentiles(self):
+        values = range(100, 0, -1)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([0.2], 95), 0.2)
+        self.assertEqual(percentile([], 95), None)
+
+    def test_facet_count_errors(self):
+        def facet_list(counts):
+            facet_list = FacetList()
+            facet = Facet('region', 'Region')
+            for value, count in counts:
+                facet.items.append(FacetItem(value, count))
+            facet_list.append(facet)
+            return facet_list
+        exact = facet_list([('Asia', 40), ('Europe', 20), ('Africa', 2), ('Oceania', 0)])
+        approximate = facet_list([('Asia', 50), ('Europe', 20)])
+        self.assertEqual(facet_count_errors(exact, approximate), ([0.25, 0.0], 1))
+
+class QueryLogTestCase(unittest.TestCase):
+    def test_writes_records_in_the_background(self):
+        class ListSink(object):
+            records = []
+            def write(self, records):
+                self.records.extend(records)
+        class LastSearch(object):
+            class searcher(object):
+                model = None
+            cleaned_filters = {'region': ['Europe', 'Asia']}
+            keywords = 'hiking'
+            order_by = 'name'
+            hit_count = 12
+            facets = FacetListFactory.build(with_auto_facets=True, number_of_facets=1, unselected_items=2)
+        query_log = QueryLog(ListSink())
+        query_log.record(LastSearch, {'facets': 0.0125})
+        query_log.queue.join()
+
+        record = ListSink.records[0]
+        self.assertEqual(record['filters'], {'region': ['Asia', 'Europe']})
+        self.assertEqual(record['count'], 12)
+        self.assertEqual(record['facets'].values(), [3])
+        self.assertEqual(record['timings'], {'facets': 12.5})
+
+class MultiValueDateFieldTestCase(unittest.TestCase):
+    def test_converts_dates(self):
+        field = MultiValueDateField()
+        field.instance_name = 'departure_dates'
+        self.assertEqual(
+            field.convert(['2014-05-01 00:00:00', '2014-05-01T00:00:00Z', '2014-06-02  10:00:00', datetime.date(2014, 7, 3)]),
+            [datetime.date(2014, 5, 1), datetime.date(2014, 5, 1), datetime.date(2014, 6, 2), datetime.date(2014, 7, 3)],
+        )
+        self.assertRaises(SearchFieldError, field.convert, ['2014-02-30 00:00:00'])
+
+    def test_compresses_dates(self):
+        weekly = [datetime.date(2014, 3, 1) + datetime.timedelta(weeks=w) for w in range(35)]
+        self.assertEqual(compress_dates(weekly + [datetime.date(2014, 12, 24), datetime.date(2014, 3, 1)]),
+                         ['[2014-03-01 TO 2014-10-25]', '2014-12-24'])
+
+class CompactDateFieldTestCase(StubBackendTestCase):
+    facets = {'ranges': {'departure_ranges': {'counts': [['2014-03-01T00:00:00Z', 4], ['2014-04-01T00:00:00Z', 2]]}}}
+
+    def setUp(self):
+        super(CompactDateFieldTestCase, self).setUp()
+        self.searcher = Searcher(model=Site, facets={'dates': {'departure_dates': {
+            'start_date': datetime.datetime(2014, 3, 1),
+            'end_date': datetime.datetime(2014, 5, 1),
+            'gap_by': 'month',
+            'range_field': 'departure_ranges',
+        }}})
+
+    def test_counts_date_facets_on_ranges(self):
+        search = self.searcher.search({'departure_dates': '2014-03'})
+        self.assertEqual([(i.value, i.label, i.count, i.is_selected) for i in search.facets['departure_dates']],
+                         [('2014-03', 'March', 4, True), ('2014-04', 'April', 2, False)])
+        query_string, kwargs = self.requests[0]
+        self.assertEqual(kwargs['range_facets']['departure_ranges']['gap'], '+1MONTH/MONTH')
+        self.assertEqual(kwargs['narrow_queries'],
+                         set(['departure_ranges:[2014-03-01T00:00:00Z TO 2014-03-31T23:59:59Z]']))
+
+    def test_narrows_short_windows_on_dates(self):
+        narrows, selected = self.searcher._narrows({'departure_dates': '2014-03-02-2014-03-04'})
+        self.assertEqual(narrows, ['departure_dates_exact:[2014-03-02T00:00:00Z TO 2014-03-04T23:59:59Z]'])
+        narrows, selected = self.searcher._narrows({'departure_dates': '2014-03-02-2014-03-08'})
+        self.assertEqual(narrows, ['departure_ranges:[2014-03-02T00:00:00Z TO 2014-03-08T23:59:59Z]'])
+
+class DegradedFacetsTestCase(unittest.TestCase):
+    def test_finds_parent_states(self):
+        parents = Searcher()._parent_filters({'region': ['Asia', 'Europe'], 'country': 'Peru'})
+        self.assertEqual(parents, [
+            {'region': ['Asia', 'Europe']},
+            {'region': ['Europe'], 'country': 'Peru'},
+            {'region': ['Asia'], 'country': 'Peru'},
+        ])
+
+    def test_waits_for_deferred_facets(self):
+        search = Search(Searcher(facet_cache=None))
+        self.assertTrue(search.wait_facets() is search.facets)
+        try:
+            raise ValueError('backend down')
+        except ValueError:
+            search.facets_error = sys.exc_info()
+        self.assertRaises(ValueError, search.wait_facets)
+
+    def test_degrades_to_no_facets_without_a_cache(self):
+        searcher = Searcher(facet_cache=None)
+        facet_list = searcher._degraded_facets(Search(searcher, keywords='hiking'), {'q': 'hiking'})
+        self.assertTrue(facet_list.degraded)
+        self.assertEqual(list(facet_list), [])
+
+class NarrowsTestCase(unittest.TestCase):
+    def setUp(self):
+        class Field(object):
+            faceted = True
+        self.searcher = Searcher(facets={
+            'fields': {
+                'region': {'multiselect': True, 'filter_cache': False, 'filter_cost': 50},
+                'activity': {'filter_group': 'common'},
+                'service_level': {'filter_group': 'common'},
+            },
+            'dates': {'departure_dates': {'filter_round': 'month'}},
+        })
+        self.searcher.indexed_fields = dict((f, Field()) for f in ('region', 'activity', 'service_level',
+                                                                   'departure_dates', 'duration'))
+
+    def test_sorts_values_and_adds_cache_hints(self):
+        narrows, selected = self.searcher._narrows({'region': ['Europe', 'Asia']})
+        self.assertEqual(narrows, ['{!tag=region cache=false cost=50}region_exact:(Asia OR Europe)'])
+        self.assertEqual(self.searcher._narrows({'region': ['Europe', 'Asia']}, tag=False)[0],
+                         ['region_exact:(Asia OR Europe)'])
+
+    def test_narrows_on_range_buckets(self):
+        for lower, upper, query in build_ranges(5, 20, 5, before=True, after=True):
+            search = Search(self.searcher, {'duration': query})
+            narrows, search.selected_values = self.searcher._narrows(search.cleaned_filters)
+            self.assertEqual(narrows, ['duration_exact:%s' % query])
+            self.assertTrue(self.searcher._is_selected_facet(search, 'duration', query))
+        self.assertEqual(self.searcher._narrows({'region': 'South America'}, tag=False)[0],
+                         ['region_exact:South\\ America'])
+
+    def test_rounds_date_ranges(self):
+        narrows, selected = self.searcher._narrows({'departure_dates': '2014-05-03-2014-06-20'})
+        self.assertEqual(narrows, [
+            'departure_dates_exact:[2014-05-01T00:00:00Z TO 2014-06-30T23:59:59Z]',
+            '{!cache=false}departure_dates_exact:[2014-05-03T00:00:00Z TO 2014-06-20T23:59:59Z]',
+        ])
+        narrows, selected = self.searcher._narrows({'departure_dates': '2014-05'})
+        self.assertEqual(narrows, ['departure_dates_exact:[2014-05-01T00:00:00Z TO 2014-05-31T23:59:59Z]'])
+
+    def test_merges_filter_groups(self):
+        narrows, selected = self.searcher._narrows({'activity': 'Hiking', 'service_level': 'Basic'})
+        self.assertEqual(narrows, ['(activity_exact:Hiking) AND (service_level_exact:Basic)'])
+
+class FacetCacheInvalidatorTestCase(unittest.TestCase):
+    def state_keys(self, filters, keywords=''):
+        return set(state_version_keys('trips.trip', filters, keywords, exact_fields=set(['region', 'country']),
+                                      recorded_fields=set(['region', 'country', 'duration']),
+                                      multiselect_fields=set(['region'])))
+
+    def test_invalidates_overlapping_states(self):
+        invalidator = FacetCacheInvalidator(facet_cache=None)
+        changed = invalidator._changed_keys('trips.trip', {'region': ['Asia'], 'country': ['Nepal'], 'duration': ['10']},
+                                            {'region': ['Asia'], 'country': ['India'], 'duration': ['10']})
+        self.assertTrue(self.state_keys({}) & changed)
+        self.assertTrue(self.state_keys({'country': 'Nepal'}) & changed)
+        self.assertTrue(self.state_keys({'duration': '[5 TO 10]'}) & changed)
+        self.assertFalse(self.state_keys({'country': ['Peru', 'Chile']}) & changed)
+        # Multi-select filters don't restrict their facet's counts
+        self.assertTrue(self.state_keys({'region': 'Europe'}) & changed)
+
+    def test_unchanged_documents_only_invalidate_keyword_and_unrecorded_states(self):
+        invalidator = FacetCacheInvalidator(facet_cache=None)
+        values = {'region': ['Asia'], 'country': ['Nepal']}
+        changed = invalidator._changed_keys('trips.trip', values, dict(values))
+        self.assertFalse(self.state_keys({}) & changed)
+        self.assertTrue(self.state_keys({'country': 'Peru'}, keywords='hiking') & changed)
+        # the document may have moved in or out of filters on fields that aren't recorded
+        self.assertTrue(self.state_keys({'name': 'Everest'}) & changed)
+
+    def test_invalidates_from_indexed_documents(self):
+        cache.clear()
+        invalidator = FacetCacheInvalidator(FacetCache())
+        prepared = []
+        class CountingIndex(StubIndex):
+            def full_prepare(self, obj):
+                prepared.append(obj)
+                return dict(super(CountingIndex, self).full_prepare(obj), region='Asia', name=obj.name)
+
+        backend = FacetedSolrSearchBackend('default', URL='http://localhost:8983/solr')
+        backend.conn.add = lambda docs, **kwargs: None
+        asia_keys = state_version_keys('sites.site', {'region': 'Asia'}, '', set(['region']), set(['region']))
+        name_keys = state_version_keys('sites.site', {'name': 'K2'}, '', set(['region']), set(['region']))
+        default_invalidator = solr_backend.default_invalidator
+        solr_backend.default_invalidator = invalidator
+        try:
+            backend.update(CountingIndex(), [Site(pk=1, name='Everest')])
+            versions = invalidator.version(asia_keys), invalidator.version(name_keys)
+            backend.update(CountingIndex(), [Site(pk=1, name='K2')])
+        finally:
+            solr_backend.default_invalidator = default_invalidator
+        # each document is prepared once, for both the backend and the invalidator
+        self.assertEqual(len(prepared), 2)
+        self.assertEqual(invalidator.version(asia_keys), versions[0])
+        self.assertNotEqual(invalidator.version(name_keys), versions[1])
+
+class FacetSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'facets.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reads_payloads(self):
+        payloads = dict(('key-%d' % i, (i, (('region', 'Region'),), False)) for i in range(50))
+        self.assertEqual(write_snapshot(self.path, payloads), 50)
+        snapshot = FacetSnapshot(self.path, check_interval=0)
+        self.assertEqual(snapshot.get('key-7'), payloads['key-7'])
+        self.assertEqual(snapshot.get('key-49'), payloads['key-49'])
+        self.assertEqual(snapshot.get('missing'), None)
+
+        write_snapshot(self.path, {'key-50': (50, (), True)})
+        self.assertEqual(snapshot.get('key-7'), None)
+        self.assertEqual(snapshot.get('key-50'), (50, (), True))
+
+    def test_missing_snapshot(self):
+        self.assertEqual(FacetSnapshot(self.path).get('key'), None)
+
+class SnapshotSearchTestCase(StubBackendTestCase):
+    facets = {'fields': {'region_exact': [['Asia', 40], ['Europe', 30]]}}
+
+    def setUp(self):
+        super(SnapshotSearchTestCase, self).setUp()
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'facets.snapshot')
+        self.facet_cache = FacetCache()
+        self.invalidator = FacetCacheInvalidator(self.facet_cache)
+
+    def tearDown(self):
+        super(SnapshotSearchTestCase, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def searcher(self, snapshot=None):
+        return Searcher(model=Site, facets={'fields': {'region': {}}}, facet_cache=self.facet_cache,
+                        invalidator=self.invalidator, snapshot=snapshot)
+
+    def test_reads_snapshot_until_invalidated(self):
+        build_snapshot(self.searcher(), [({'region': 'Asia'}, '')], self.path, workers=1)
+        self.assertEqual(len(self.requests), 1)
+        searcher = self.searcher(FacetSnapshot(self.path, check_interval=0))
+        # so the facets come from the snapshot
+        self.facet_cache.cache.delete(searcher.facet_cache_key(Search(searcher, {'region': 'Asia'})))
+
+        search = searcher.search({'region': 'Asia'})
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(search.hit_count, 120)
+        self.assertEqual([(i.value, i.count, i.is_selected) for i in search.facets['region']],
+                         [('Asia', 40, True), ('Europe', 30, False)])
+
+        self.invalidator.removed('sites.site.1')
+        search = searcher.search({'region': 'Asia'})
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(search.facets['region']['Asia'].count, 40)
+
+STREAMING_TEMPLATES = [{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'OPTIONS': {'loaders': [('django.template.loaders.locmem.Loader', {
+        'head.html': '{{ search.hit_count }} {{ search.facets|length }}|',
+        'facets.html': '{% for facet in facets %}{% for item in facet %}{{ item.value }}={{ item.count }} '
+                       '{% endfor %}{% endfor %}{% if facets.degraded %}degraded{% endif %}|',
+        'tail.html': '{{ search.hit_count }}',
+    })]},
+}]
+
+class DeferredFacetsTestCase(StubBackendTestCase):
+    facets = {'fields': {'region_exact': [['Asia', 40], ['Europe', 30]]}}
+
+    def setUp(self):
+        super(DeferredFacetsTestCase, self).setUp()
+        self.counted = threading.Event()
+        self.fail = False
+
+    def tearDown(self):
+        self.counted.set()
+        super(DeferredFacetsTestCase, self).tearDown()
+
+    def respond(self, query_string, kwargs, response):
+        # Facet counts only arrive once the test is ready for them
+        if threading.current_thread().name == 'facet-search':
+            self.counted.wait(5)
+            if self.fail:
+                raise IOError('backend down')
+        return response
+
+    def test_counts_facets_in_the_background(self):
+        search = Searcher(model=Site, facets={'fields': {'region': {}}}).search({'region': 'Asia'}, defer_facets=True)
+        self.assertTrue(search.facets_thread.is_alive())
+        self.assertEqual((len(search.facets), search.hit_count), (0, None))
+        # the results have their own queryset
+        self.assertEqual(search.count(), 120)
+
+        self.counted.set()
+        facets = search.wait_facets()
+        self.assertTrue(facets is search.facets)
+        self.assertEqual(search.hit_count, 120)
+        self.assertEqual([i.value for i in facets.selected_facet_items()], ['Asia'])
+
+    @override_settings(TEMPLATES=STREAMING_TEMPLATES)
+    def test_streams_results_before_facets(self):
+        view = StreamingSearchView.as_view(model=Site, facets={'fields': {'region': {}}}, head_template_name='head.html',
+                                           facets_template_name='facets.html', tail_template_name='tail.html')
+        response = view(RequestFactory().get('/trips/', {'region': 'Asia'}))
+        parts = iter(response.streaming_content)
+        self.assertEqual(next(parts), 'None 0|')
+        self.counted.set()
+        self.assertEqual(list(parts), ['Asia=40 Europe=30 |', '120'])
+
+        self.fail = True
+        response = view(RequestFactory().get('/trips/', {'region': 'Asia'}))
+        self.assertEqual(list(response.streaming_content), ['None 0|', 'degraded|', 'None'])
+
+    @override_settings(TEMPLATES=STREAMING_TEMPLATES)
+    def test_shares_the_searcher_between_requests(self):
+        searchers = []
+        class SearchView(StreamingSearchView):
+            def get_context_data(self, **kwargs):
+                searchers.append(self.searcher)
+                return kwargs
+
+        self.counted.set()
+        view = SearchView.as_view(model=Site, facets={'fields': {'region': {}}}, head_template_name='head.html',
+                                  facets_template_name='facets.html', tail_template_name='tail.html')
+        for region in ('Asia', 'Europe'):
+            list(view(RequestFactory().get('/trips/', {'region': region})).streaming_content)
+        self.assertEqual(len(searchers), 2)
+        self.assertTrue(searchers[0] is searchers[1])
+        self.assertEqual((searchers[0].model, list(searchers[0].field_facets)), (Site, ['region']))
+
+class RunParallelTestCase(unittest.TestCase):
+    def test_keeps_order(self):
+        self.assertEqual(run_parallel(lambda n: n * n, range(10), 3), [n * n for n in range(10)])
+        self.assertEqual(run_parallel(lambda n: n, [], 3), [])
+
+    def test_raises_errors(self):
+        self.assertRaises(ZeroDivisionError, run_parallel, lambda n: 1 / n, [1, 0, 2], 2)
+
+class FacetValueIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = FacetValueIndex([(u'Zambia', 31), (u'Zanzibar', 12), (u'Zürich', 8), (u'Åland', 3), (u'Zagreb', 40)])
 
+    def test_match(self):
+        self.assertEqual(self.index.match('za'), [(u'Zagreb', 40), (u'Zambia', 31), (u'Zanzibar', 12)])
+        self.assertEqual(self.index.match('ZA', 2), [(u'Zagreb', 40), (u'Zambia', 31)])
+        self.assertEqual(self.index.match('zu'), [(u'Zürich', 8)])
+        self.assertEqual(self.index.match(u'ål'), [(u'Åland', 3)])
+        self.assertEqual(self.index.match('x'), [])
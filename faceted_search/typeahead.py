@@ -0,0 +1,86 @@
+import time
+import bisect
+import logging
+import threading
+import unicodedata
+
+from django.conf import settings
+from haystack.query import SearchQuerySet
+
+from faceted_search.cache import index_version
+
+logger = logging.getLogger(__name__)
+
+# Seconds before a value index is rebuilt even if the index wasn't updated
+FACET_TYPEAHEAD_MAX_AGE = getattr(settings, 'FACET_TYPEAHEAD_MAX_AGE', 60 * 60)
+# Seconds a value index is kept after an index update, so frequent
+# updates don't cause constant rebuilds
+FACET_TYPEAHEAD_MIN_AGE = getattr(settings, 'FACET_TYPEAHEAD_MIN_AGE', 60)
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def normalize(value):
+    '''
+    Case and accent insensitive form of a facet value for prefix matching
+    '''
+    if not isinstance(value, unicode):
+        value = unicode(value, 'utf-8')
+    value = unicodedata.normalize('NFKD', value)
+    return u''.join(c for c in value if not unicodedata.combining(c)).lower()
+
+
+class FacetValueIndex(object):
+    '''
+    The values of a facet field, sorted by their normalized form so that
+    values with a prefix are found by bisection.
+    '''
+    def __init__(self, value_counts, version=None):
+        entries = sorted((normalize(value), value, count) for value, count in value_counts)
+        self.keys = [key for key, value, count in entries]
+        self.entries = entries
+        self.version = version
+        self.built = time.time()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def match(self, prefix, limit=None):
+        '''
+        (value, count) of the values starting with prefix, by decreasing
+        unfiltered count
+        '''
+        prefix = normalize(prefix)
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + u'\uffff')
+        matches = sorted(self.entries[start:end], key=lambda entry: -entry[2])
+        return [(value, count) for key, value, count in matches[:limit]]
+
+    def is_stale(self, version):
+        age = time.time() - self.built
+        if age > FACET_TYPEAHEAD_MAX_AGE:
+            return True
+        return version != self.version and age > FACET_TYPEAHEAD_MIN_AGE
+
+
+def get_value_index(model, field):
+    '''
+    The FacetValueIndex of a model's facet field, built from the unfiltered
+    facet counts and shared by all requests of the process.
+    '''
+    key = (model and model._meta.db_table, field)
+    version = index_version()
+    value_index = _indexes.get(key)
+    if value_index is not None and not value_index.is_stale(version):
+        return value_index
+
+    queryset = SearchQuerySet().models(model).facet(field, limit=-1, mincount=1)
+    query = queryset.query
+    query.set_limits(0, 0)
+    value_counts = query.get_facet_counts().get('fields', {}).get(field, [])
+    value_index = FacetValueIndex(value_counts, version)
+    logger.debug('Built value index of %s with %d values' % (field, len(value_index)))
+    with _indexes_lock:
+        _indexes[key] = value_index
+    return value_index
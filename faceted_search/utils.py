@@ -1,7 +1,12 @@
 import logging
 import re
+import sys
+import threading
+from functools import wraps
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from django.conf import settings
+from django.utils.translation import get_language
 import calendar
 
 logger = logging.getLogger(__name__)
@@ -10,19 +15,135 @@ DATETIME_REGEX = re.compile('^(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})(T|
 YEAR_MONTH_REGEX = re.compile('^(?P<year>\d{4})-(?P<month>\d{2})$')
 DATE_RANGE_REGEX = re.compile('^(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})-(?P<year2>\d{4})-(?P<month2>\d{2})-(?P<day2>\d{2})$')
 EXACT_DATE_REGEX = re.compile('^(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})$')
+SOLR_DATE_RANGE_REGEX = re.compile('^\[(?P<start>\d{4}-\d{2}-\d{2}T[^ ]+) TO (?P<end>\d{4}-\d{2}-\d{2}T[^ ]+)\]$')
 SOLR_RANGE = '[%s TO %s]'
 SOLR_MONTH_RANGE_START = "%Y-%m-%dT00:00:00Z"
 SOLR_MONTH_RANGE_END = "%Y-%m-%dT23:59:59Z"
 
+# Most labels kept by the label cache
+FACET_LABEL_CACHE_SIZE = getattr(settings, 'FACET_LABEL_CACHE_SIZE', 10000)
+
+class LabelCache(object):
+    '''
+    A bounded least recently used cache of facet item labels, shared by all
+    requests of the process. Facet values are few and stable, so most
+    labels are built once. Keys include the active language.
+    '''
+    def __init__(self, size=FACET_LABEL_CACHE_SIZE):
+        self.size = size
+        self.labels = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, kind, build, *args):
+        '''
+        The label of kind for args, built with build(*args) if not cached
+        '''
+        key = (kind, args, get_language())
+        with self.lock:
+            label = self.labels.pop(key, None)
+            if label is not None:
+                self.labels[key] = label
+                return label
+        label = build(*args)
+        with self.lock:
+            self.labels[key] = label
+            if len(self.labels) > self.size:
+                self.labels.popitem(last=False)
+        return label
+
+    def clear(self):
+        with self.lock:
+            self.labels.clear()
+
+label_cache = LabelCache()
+
+def cached_label(kind):
+    '''
+    Decorates a label function of hashable arguments to use the label cache
+    '''
+    def decorator(func):
+        @wraps(func)
+        def cached(*args):
+            return label_cache.get(kind, func, *args)
+        return cached
+    return decorator
+
+RANGE_BELOW_REGEX = re.compile(r'\[\* TO (\d*)\]')
+RANGE_REGEX = re.compile(r'\[(\d*) TO (\d*)\]')
+RANGE_ABOVE_REGEX = re.compile(r'\[(\d*) TO \*\]')
+
+@cached_label('range')
 def humanize_range(query):
-    m = re.match(r'\[\* TO (\d*)\]', query)
+    m = RANGE_BELOW_REGEX.match(query)
     if m and m.groups(): return "Less than %s" % m.groups()
-    m = re.match(r'\[(\d*) TO (\d*)\]', query)
+    m = RANGE_REGEX.match(query)
     if m and m.groups(): return "%s to %s" % m.groups()
-    m = re.match(r'\[(\d*) TO \*\]', query)
+    m = RANGE_ABOVE_REGEX.match(query)
     if m and m.groups(): return "%s and up" % m.groups()
     return query
         
+def build_ranges(start, end, gap, before=False, after=False, **kwargs):
+    '''
+    Returns the (lower, upper, query) buckets described by a range facet
+    config. Open-ended tails have a bound of None. Ranges include their
+    lower bound only, except the last which also includes `end`, matching
+    how range facets are counted by the backend.
+
+    >>> build_ranges(0, 1000, 500, after=True)
+    [(0, 500, '[0 TO 500}'), (500, 1000, '[500 TO 1000]'), (1000, None, '{1000 TO *]')]
+    '''
+    ranges = []
+    if before:
+        ranges.append((None, start, '[* TO %s}' % start))
+    lower = start
+    while lower < end:
+        upper = min(lower + gap, end)
+        closing = ']' if upper == end else '}'
+        ranges.append((lower, upper, '[%s TO %s%s' % (lower, upper, closing)))
+        lower = upper
+    if after:
+        ranges.append((end, None, '{%s TO *]' % end))
+    return ranges
+
+@cached_label('bounds')
+def humanize_bounds(lower, upper):
+    if lower is None: return "Less than %s" % upper
+    if upper is None: return "More than %s" % lower
+    return "%s to %s" % (lower, upper)
+
+def run_parallel(func, items, workers):
+    '''
+    Returns [func(item) for item in items], calling func on up to `workers`
+    threads at once. The first exception raised by func is re-raised.
+    '''
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    pending = list(reversed(list(enumerate(items))))
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if not pending or errors:
+                    return
+                index, item = pending.pop()
+            try:
+                results[index] = func(item)
+            except Exception:
+                with lock:
+                    errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=work) for i in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        exc_type, exc_value, traceback = errors[0]
+        raise exc_type, exc_value, traceback
+    return results
+
 def check_parse_date(value):
     '''
     Dates in the url will not be passed in the solr range format,
@@ -68,5 +189,39 @@ def parse_date_range(date_range):
         return (start_date, end_date)
     return None
 
+def round_date_range(value, unit):
+    '''
+    Widens a Solr date range to whole months or years, so that the narrows
+    of nearby ranges are the same (and share a filter cache entry). Values
+    that aren't date ranges are returned unchanged.
+
+    >>> round_date_range('[2010-12-03T00:00:00Z TO 2011-01-20T23:59:59Z]', 'month')
+    '[2010-12-01T00:00:00Z TO 2011-01-31T23:59:59Z]'
+    '''
+    match = SOLR_DATE_RANGE_REGEX.match(value)
+    if not match:
+        return value
+    start = datetime.strptime(match.group('start')[:19], '%Y-%m-%dT%H:%M:%S')
+    end = datetime.strptime(match.group('end')[:19], '%Y-%m-%dT%H:%M:%S')
+    if unit == 'year':
+        start, end = start.replace(month=1, day=1), end.replace(month=12, day=31)
+    elif unit == 'month':
+        start, end = start.replace(day=1), end.replace(day=calendar.monthrange(end.year, end.month)[1])
+    return SOLR_RANGE % (start.strftime(SOLR_MONTH_RANGE_START), end.strftime(SOLR_MONTH_RANGE_END))
+
+def date_range_days(value):
+    '''
+    The number of days a Solr date range covers, or None if value isn't one
+
+    >>> date_range_days('[2014-03-02T00:00:00Z TO 2014-03-04T23:59:59Z]')
+    3
+    '''
+    match = SOLR_DATE_RANGE_REGEX.match(value)
+    if not match:
+        return None
+    start = datetime.strptime(match.group('start')[:10], '%Y-%m-%d')
+    end = datetime.strptime(match.group('end')[:10], '%Y-%m-%d')
+    return (end - start).days + 1
+
 def is_valid_date_range(date_range):
     return DATE_RANGE_REGEX.match(date_range)
@@ -0,0 +1,155 @@
+import json
+import logging
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse, Http404
+from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control
+from django.views.generic import View
+
+from faceted_search.facets import Facet, FacetList
+from faceted_search.searcher import Searcher, HISTOGRAM_CACHE_TIMEOUT, SORT_PARAM
+
+CURRENCY_PARAM = 'currency'
+
+logger = logging.getLogger(__name__)
+
+class SearcherViewMixin(object):
+    '''
+    Builds the view's Searcher from its model, facets and sort_config once
+    in as_view(), rather than on every request, and shares it between the
+    requests (a Searcher keeps no per-search state). A configured Searcher
+    can be passed instead:
+
+        PriceHistogramView.as_view(searcher=trip_searcher)
+    '''
+    model = None
+    facets = {}
+    sort_config = {}
+    searcher = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        if initkwargs.get('searcher', cls.searcher) is None:
+            options = dict((name, initkwargs.get(name, getattr(cls, name)))
+                           for name in ('model', 'facets', 'sort_config'))
+            initkwargs['searcher'] = Searcher(**options)
+        return super(SearcherViewMixin, cls).as_view(**initkwargs)
+
+
+class PriceHistogramView(SearcherViewMixin, View):
+    '''
+    Returns JSON min/max stats and a histogram of the localized price field
+    (settings.PRICE_FACET_ROOT) for the filters in the query string, so the
+    price slider can show live counts without reloading the page.
+
+        url(r'^trips/prices/$', PriceHistogramView.as_view(model=Trip, facets=FACETS_DEFAULT),
+            name='trip_price_histogram')
+    '''
+    gap = getattr(settings, 'PRICE_HISTOGRAM_GAP', 50)
+
+    def get(self, request, *args, **kwargs):
+        filters = dict(request.GET.lists())
+        currency_code = filters.pop(CURRENCY_PARAM, [settings.DEFAULT_CURRENCY_CODE])[0]
+        field = Facet.localize_field(settings.PRICE_FACET_ROOT, currency_code)
+
+        if field not in self.searcher.indexed_fields:
+            raise Http404('No price field %s' % field)
+
+        data = self.searcher.histogram(field, 0, settings.PRICE_FACET_MAX, self.gap, filters)
+
+        response = HttpResponse(json.dumps(data), content_type='application/json')
+        patch_cache_control(response, public=True, max_age=HISTOGRAM_CACHE_TIMEOUT)
+        return response
+
+
+class FacetTypeaheadView(SearcherViewMixin, View):
+    '''
+    Returns JSON facet values starting with the `prefix` parameter, with
+    their counts under the filters in the rest of the query string, for
+    typeaheads on facets with too many values to list (e.g. destinations).
+    Any field facet, or parent or child of a pivot facet, can be looked up.
+
+        url(r'^trips/facet-values/$', FacetTypeaheadView.as_view(model=Trip, facets=FACETS_DEFAULT),
+            name='trip_facet_values')
+
+        GET /trips/facet-values/?field=country&prefix=za&region=Africa
+        {"field": "country", "prefix": "za",
+         "values": [{"value": "Zambia", "count": 31}, {"value": "Zanzibar", "count": 12}]}
+    '''
+    limit = getattr(settings, 'FACET_TYPEAHEAD_LIMIT', 10)
+    cache_timeout = getattr(settings, 'FACET_TYPEAHEAD_CACHE_TIMEOUT', 60)
+
+    def get(self, request, *args, **kwargs):
+        filters = dict(request.GET.lists())
+        field = filters.pop('field', [''])[0]
+        prefix = filters.pop('prefix', [''])[0]
+        try:
+            limit = min(int(filters.pop('limit', [self.limit])[0]), self.limit)
+        except ValueError:
+            limit = self.limit
+
+        if field not in self.searcher.exact_fields:
+            raise Http404('No facet field %s' % field)
+
+        values = self.searcher.facet_values(field, prefix, filters, limit) if prefix else []
+        data = {
+            'field': field,
+            'prefix': prefix,
+            'values': [{'value': value, 'count': count} for value, count in values],
+        }
+
+        response = HttpResponse(json.dumps(data), content_type='application/json')
+        patch_cache_control(response, public=True, max_age=self.cache_timeout)
+        return response
+
+
+class StreamingSearchView(SearcherViewMixin, View):
+    '''
+    Renders a search page as a streaming response, so that the page head
+    and results are sent while the facets are still being counted:
+
+        head_template_name      the page head and results, with `search`
+        facets_template_name    the facet sidebar, with `search` and `facets`
+                                (e.g. using the show_facets tags), sent
+                                when the facets are ready
+        tail_template_name      the rest of the page
+
+        url(r'^trips/$', StreamingSearchView.as_view(model=Trip, facets=FACETS_DEFAULT,
+            sort_config=SORT_OPTIONS, head_template_name='trips/search_head.html', ...),
+            name='faceted_trips')
+
+    The head is rendered before the facets are counted, so in it
+    search.facets is empty and search.hit_count is None (search.count()
+    gets the number of results). The sidebar follows the results in the
+    page, so it's positioned with CSS (or moved into place by a script).
+    If the facets can't be counted the sidebar is rendered with no
+    (degraded) facets, as the response has started.
+    '''
+    head_template_name = None
+    facets_template_name = None
+    tail_template_name = None
+
+    def get(self, request, *args, **kwargs):
+        filters = dict(request.GET.lists())
+        order_by = filters.pop(SORT_PARAM, [''])[0]
+        search = self.searcher.search(filters, order_by=order_by, defer_facets=True)
+
+        response = StreamingHttpResponse(self.render_parts(request, search))
+        # Ask proxies (e.g. nginx) to pass the parts on as they're sent
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def get_context_data(self, **kwargs):
+        return kwargs
+
+    def render_parts(self, request, search):
+        context = self.get_context_data(search=search)
+        yield render_to_string(self.head_template_name, context, request=request)
+        try:
+            context['facets'] = search.wait_facets()
+        except Exception:
+            logger.exception('Could not count facets')
+            context['facets'] = FacetList(degraded=True)
+        yield render_to_string(self.facets_template_name, context, request=request)
+        yield render_to_string(self.tail_template_name, context, request=request)